@@ -0,0 +1,100 @@
+"""
+Chat latency during a login flood
+
+Runs an eventlet process with a TCP echo "chat" connection pinged every
+10 ms, then floods it with concurrent bcrypt checks like /api/login
+does: first inline on the hub, then on PasswordPool. Prints the echo
+round-trip times during each flood and the login rate.
+    
+    python benchmarks/password_pool.py --logins 200 --concurrency 50 --rounds 12
+"""
+import eventlet
+eventlet.monkey_patch()
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bcrypt
+from passwords import PasswordPool, PasswordPoolBusy
+from storage import check_password
+
+def echo_server():
+    listener = eventlet.listen(('127.0.0.1', 0))
+    
+    def serve(conn):
+        while True:
+            data = conn.recv(64)
+            if not data:
+                return
+            conn.sendall(data)
+    
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            eventlet.spawn(serve, conn)
+    
+    eventlet.spawn(accept)
+    return listener.getsockname()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def run(name, check, address, logins, concurrency, password, password_hash):
+    chat = socket.create_connection(address)
+    chat.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    latencies = []
+    results = {'done': 0, 'refused': 0}
+    flooding = [True]
+    
+    def ping():
+        while flooding[0]:
+            started = time.perf_counter()
+            chat.sendall(b'x')
+            chat.recv(1)
+            latencies.append((time.perf_counter() - started) * 1000)
+            eventlet.sleep(0.01)
+    
+    def login(_):
+        try:
+            check(password, password_hash)
+            results['done'] += 1
+        except PasswordPoolBusy:
+            results['refused'] += 1
+    
+    pinger = eventlet.spawn(ping)
+    eventlet.sleep(0.05)
+    started = time.perf_counter()
+    pool = eventlet.GreenPool(concurrency)
+    for _ in pool.imap(login, range(logins)):
+        pass
+    elapsed = time.perf_counter() - started
+    flooding[0] = False
+    pinger.wait()
+    chat.close()
+    print(f'{name:<8} chat p50 {percentile(latencies, 0.5):7.1f} ms   p99 {percentile(latencies, 0.99):7.1f} ms   '
+          f'max {max(latencies):7.1f} ms   {results["done"] / elapsed:6.1f} logins/s   {results["refused"]} refused')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-pending', type=int, default=64)
+    args = parser.parse_args()
+    
+    password = 'correct horse'
+    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(args.rounds)).decode('utf-8')
+    address = echo_server()
+    password_pool = PasswordPool(workers=args.workers, max_pending=args.max_pending, green=True)
+    
+    run('inline', check_password, address, args.logins, args.concurrency, password, password_hash)
+    run('pool', password_pool.check, address, args.logins, args.concurrency, password, password_hash)
+
+if __name__ == '__main__':
+    main()
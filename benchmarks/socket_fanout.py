@@ -0,0 +1,159 @@
+"""
+Multi-process Socket.IO fan-out benchmark
+
+Starts the local message queue broker, then for each worker count runs
+that many Socket.IO server processes sharing the queue. Client processes
+spread their connections over the workers and join one room, and a
+broadcast to the room has to reach every client on every worker. Prints
+the connection rate and the delivery rate per worker count.
+
+    python benchmarks/socket_fanout.py --workers 1 2 4 --clients 400 --messages 20
+
+Needs the Socket.IO client extras (pip install "python-socketio[client]").
+Scaling is only near-linear while there are free CPU cores for the workers.
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'worker on port {port} did not start')
+
+def serve(port, queue_url):
+    """One worker process: a bare Socket.IO app on the shared queue"""
+    import eventlet
+    eventlet.monkey_patch()
+    from flask import Flask
+    from flask_socketio import SocketIO, join_room
+    from message_queue import socketio_queue_options
+    
+    app = Flask(__name__)
+    sio = SocketIO(app, async_mode='eventlet', **socketio_queue_options(queue_url))
+    
+    @sio.on('join')
+    def on_join():
+        join_room('bench')
+        return True
+    
+    @sio.on('broadcast')
+    def on_broadcast(data):
+        sio.emit('tick', data, room='bench')
+        return True
+    
+    sio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+def run_clients(urls, count, messages, connected, results):
+    """Client process: `count` connections spread over `urls`"""
+    import socketio
+    
+    received = [0]
+    lock = threading.Lock()
+    done = threading.Event()
+    expected = count * messages
+    clients = []
+    
+    def on_tick(data):
+        with lock:
+            received[0] += 1
+            if received[0] >= expected:
+                done.set()
+    
+    started = time.perf_counter()
+    for i in range(count):
+        client = socketio.Client()
+        client.on('tick', on_tick)
+        client.connect(urls[i % len(urls)], transports=['websocket'])
+        client.call('join')
+        clients.append(client)
+    connected.put(time.perf_counter() - started)
+    
+    done.wait(120)
+    results.put((time.perf_counter(), received[0]))
+    for client in clients:
+        client.disconnect()
+
+def run(workers, clients, messages, client_processes, queue_url):
+    import socketio
+    
+    ports = [free_port() for _ in range(workers)]
+    servers = [subprocess.Popen([sys.executable, __file__, '--serve', str(port), '--queue', queue_url])
+               for port in ports]
+    try:
+        for port in ports:
+            wait_for_port(port)
+        urls = [f'http://127.0.0.1:{port}' for port in ports]
+        
+        connected = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        share = clients // client_processes
+        procs = [multiprocessing.Process(target=run_clients, args=(urls, share, messages, connected, results))
+                 for _ in range(client_processes)]
+        started = time.perf_counter()
+        for proc in procs:
+            proc.start()
+        for _ in procs:
+            connected.get(timeout=300)
+        connect_time = time.perf_counter() - started
+        
+        sender = socketio.Client()
+        sender.connect(urls[0], transports=['websocket'])
+        started = time.perf_counter()
+        for i in range(messages):
+            sender.call('broadcast', {'n': i})
+        finished = [results.get(timeout=300) for _ in procs]
+        delivery_time = max(at for at, _ in finished) - started
+        delivered = sum(count for _, count in finished)
+        sender.disconnect()
+        for proc in procs:
+            proc.join()
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    
+    total = share * client_processes
+    print(f'{workers} worker(s): {total} connections in {connect_time:6.2f}s ({total / connect_time:7.0f}/s), '
+          f'{delivered}/{total * messages} deliveries in {delivery_time:6.2f}s ({delivered / delivery_time:8.0f}/s)')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=400)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--client-processes', type=int, default=4)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--queue', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.serve:
+        serve(args.serve, args.queue)
+        return
+    
+    from message_queue import LocalBroker
+    broker = LocalBroker(('127.0.0.1', free_port())).start()
+    print(f'broker {broker.url}, {os.cpu_count()} CPU(s)')
+    for workers in args.workers:
+        run(workers, args.clients, args.messages, args.client_processes, broker.url)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Snapshot codec benchmark for JSONStorage
+
+Dumps and loads a synthetic messages collection with every available
+codec and prints write time, load time and file size.
+    
+    python benchmarks/storage_codecs.py --messages 1000000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
+
+def make_messages(count):
+    start = datetime(2024, 1, 1)
+    return [{
+        'channel_id': i % 50 + 1,
+        'user_id': i % 500 + 1,
+        'content': f'Привет! Сообщение номер {i}, как дела?',
+        'id': i + 1,
+        'created_at': (start + timedelta(seconds=i)).isoformat()
+    } for i in range(count)]
+
+def legacy_dumps(data):
+    """Format used before the codec layer (indent=2)"""
+    return json.dumps(data, indent=2, ensure_ascii=False, default=str).encode('utf-8')
+
+def measure(name, dumps, loads, messages, directory):
+    path = os.path.join(directory, name)
+    started = time.perf_counter()
+    with open(path, 'wb') as f:
+        f.write(dumps(messages))
+    write_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        loaded = loads(f.read())
+    load_time = time.perf_counter() - started
+    
+    assert len(loaded) == len(messages)
+    size = os.path.getsize(path)
+    os.remove(path)
+    print(f'{name:<22} write {write_time:7.2f}s   load {load_time:7.2f}s   size {size / 1024 / 1024:8.1f} MiB')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000000)
+    args = parser.parse_args()
+    
+    messages = make_messages(args.messages)
+    print(f'{args.messages} messages, orjson: {storage.orjson is not None}, msgpack: {storage.msgpack is not None}')
+    with tempfile.TemporaryDirectory() as directory:
+        measure('json indent=2 (old)', legacy_dumps, json.loads, messages, directory)
+        measure('json compact', lambda d: json.dumps(d, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+                json.loads, messages, directory)
+        if storage.orjson is not None:
+            codec = storage.CODECS['json']
+            measure('json compact (orjson)', codec.dumps, codec.loads, messages, directory)
+        if storage.msgpack is not None:
+            codec = storage.CODECS['msgpack']
+            measure('msgpack', codec.dumps, codec.loads, messages, directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Concurrent write benchmark for JSONStorage
+
+Runs a burst of message and DM-channel writes from several threads and
+compares no fsync, fsync on every write (commit window 0) and group
+commit.
+    
+    python benchmarks/storage_writes.py --threads 16 --writes 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import storage
+
+def run(name, threads, writes, **options):
+    with tempfile.TemporaryDirectory() as directory:
+        store = storage.JSONStorage(directory, **options)
+        
+        def worker(number):
+            for i in range(writes):
+                store.add('messages', {'channel_id': number % 4 + 1, 'user_id': number, 'content': f'сообщение {i}'})
+                store.add('dm_channels', {'user1_id': number, 'user2_id': i})
+        
+        workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        started = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    total = threads * writes * 2
+    print(f'{name:<22} {total} writes in {elapsed:6.2f}s   {total / elapsed:8.0f} writes/s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--writes', type=int, default=200)
+    parser.add_argument('--window-ms', type=float, default=2)
+    args = parser.parse_args()
+    
+    run('no fsync', args.threads, args.writes, fsync=False)
+    run('fsync, no window', args.threads, args.writes, fsync=True, commit_window=0)
+    run('group commit', args.threads, args.writes, fsync=True, commit_window=args.window_ms / 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Change log for incremental sync
+
+Every change a client has to learn about besides messages goes to the
+`changes` collection. Changes of one user (a server joined, a friend
+request, a friendship, a DM channel) are appended to that user's log.
+Changes of a server that all its members see (a member or channel added)
+are appended once, to the server's log, whatever the server's size. The
+collection is partitioned by user and by server, so reading a log after
+an id touches only its newest segment.
+
+GET /api/sync takes the token returned by the previous sync and answers
+with the user's changes after it merged with the logs of their servers,
+the new messages in their channels and DMs and the users whose status
+changed. A reconnecting client catches up in O(changes) instead of
+reloading everything. Tokens are opaque to clients; a token the server
+cannot continue from (malformed, from a wiped storage or too far behind)
+gets reset=true and the client reloads.
+
+Change ids come from one sequence for all logs. Only the newest
+`retention` changes are kept: each time another tenth of that has been
+added the older ones are deleted, and a token from before them gets
+reset=true.
+"""
+
+class ChangeLog:
+    """Append-only per-user and per-server log of changes"""
+    
+    def __init__(self, storage, retention=100000):
+        self.storage = storage
+        self.retention = retention
+        # Delete expired changes each time this many were added
+        self.trim_every = max(retention // 10, 1)
+    
+    def record(self, user_ids, kind, data):
+        """Append one change to the log of each user"""
+        user_ids = list(dict.fromkeys(user_ids))
+        if user_ids:
+            self._add([{'user_id': user_id, 'kind': kind, 'data': data} for user_id in user_ids])
+    
+    def record_server(self, server_id, kind, data):
+        """Append one change to the log of a server, for all of its members"""
+        self._add([{'server_id': server_id, 'kind': kind, 'data': data}])
+    
+    def _add(self, changes):
+        changes = self.storage.add_many('changes', changes)
+        first_id, last_id = changes[0]['id'], changes[-1]['id']
+        if last_id // self.trim_every > (first_id - 1) // self.trim_every:
+            self.storage.delete_before('changes', self.floor(last_id) + 1)
+    
+    def floor(self, last_id):
+        """Oldest change id a sync can continue from while the newest is last_id"""
+        return max(last_id - self.retention, 0)
+    
+    def since(self, user_id, server_ids, change_id, last_id, limit):
+        """Up to `limit` changes for a user in (change_id, last_id], oldest first, and whether more exist.
+        
+        The user's own log merged with the logs of server_ids, leaving out
+        what a server logged before the user joined it and their own join.
+        """
+        changes, more = self.storage.get_page('changes', 'user_id', user_id, limit, after=change_id)
+        joined = {change['data']['server_id']: change['id'] for change in changes if change['kind'] == 'server_joined'}
+        for server_id in server_ids:
+            page, server_more = self.storage.get_page('changes', 'server_id', server_id, limit,
+                                                      after=max(change_id, joined.get(server_id, 0)))
+            more = more or server_more
+            changes += [change for change in page
+                        if not (change['kind'] == 'member_joined' and change['data'].get('user_id') == user_id)]
+        changes = sorted((change for change in changes if change['id'] <= last_id), key=lambda change: change['id'])
+        return changes[:limit], more or len(changes) > limit
+
+def make_sync_token(change_id, message_id, presence_cursor):
+    """Token for the state after change_id, message_id and a presence cursor"""
+    epoch, version = presence_cursor
+    return f'{change_id}.{message_id}.{epoch}.{version}'
+
+def parse_sync_token(token):
+    """(change_id, message_id, (epoch, version)) of a sync token, or None if it is malformed"""
+    try:
+        change_id, message_id, epoch, version = token.split('.')
+        return int(change_id), int(message_id), (epoch, int(version))
+    except (AttributeError, ValueError):
+        return None
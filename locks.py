@@ -0,0 +1,189 @@
+"""
+Instrumented locks for the storage backends
+
+Every JSONStorage and SQLiteStorage collection lock is an
+InstrumentedLock. For each acquisition it records:
+- how long the caller waited, and whether it had to wait at all (the
+  lock was held);
+- how long the lock was then held;
+- the call site: the storage method that took the lock and the first
+  caller outside the storage modules, e.g.
+  `update <- server.py:1175 update_status`.
+
+Stats are kept per lock name and call site. report() lists the hottest
+sites (most total wait first) and who holds each lock right now.
+GET /debug/locks serves it, POST /debug/locks/reset calls reset(), and
+LOCK_STATS_DUMP_INTERVAL logs it periodically.
+"""
+import os
+import sys
+import time
+from threading import Lock
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+# Frames in these modules are storage internals, not call sites
+_INTERNAL_MODULES = {'locks.py', 'storage.py', 'sqlite_storage.py'}
+# code filename -> whether it is one of _INTERNAL_MODULES
+_internal = {}
+
+def _is_internal(filename):
+    internal = _internal.get(filename)
+    if internal is None:
+        path = os.path.abspath(filename)
+        internal = os.path.dirname(path) == _HERE and os.path.basename(path) in _INTERNAL_MODULES
+        _internal[filename] = internal
+    return internal
+
+def _call_site():
+    """(storage method, caller file, line, function) of the code taking a lock"""
+    # Skip _call_site and InstrumentedLock.__enter__
+    frame = sys._getframe(2)
+    operation = frame.f_code.co_name
+    while frame is not None and _is_internal(frame.f_code.co_filename):
+        frame = frame.f_back
+    if frame is None:
+        return (operation, None, 0, None)
+    return (operation, os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
+
+def _format_site(site):
+    operation, filename, line, function = site
+    if filename is None:
+        return operation
+    return f'{operation} <- {filename}:{line} {function}'
+
+class _SiteStats:
+    def __init__(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+    
+    def as_dict(self):
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait_total': round(self.wait_total, 6),
+            'wait_max': round(self.wait_max, 6),
+            'hold_total': round(self.hold_total, 6),
+            'hold_max': round(self.hold_max, 6)
+        }
+
+class _LockStats:
+    """Stats of every lock with one name"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        # call site -> _SiteStats
+        self.sites = {}
+        # Call site of the current holder and when it got the lock
+        self.holder = None
+        self.held_since = 0.0
+    
+    def acquired(self, site, waited, contended, now):
+        with self.lock:
+            stats = self.sites.get(site)
+            if stats is None:
+                stats = self.sites[site] = _SiteStats()
+            stats.acquisitions += 1
+            if contended:
+                stats.contended += 1
+                stats.wait_total += waited
+                stats.wait_max = max(stats.wait_max, waited)
+            self.holder = site
+            self.held_since = now
+    
+    def released(self, site, held):
+        with self.lock:
+            stats = self.sites[site]
+            stats.hold_total += held
+            stats.hold_max = max(stats.hold_max, held)
+            self.holder = None
+
+# lock name -> _LockStats
+_stats = {}
+_stats_lock = Lock()
+
+def _stats_for(name):
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = _LockStats(name)
+        return stats
+
+class InstrumentedLock:
+    """Non-reentrant lock recording wait time, hold time and call site of every acquisition.
+    
+    `waits` and `holds` are optional histogram series (see metrics.py)
+    observed with the wait and hold times.
+    """
+    
+    def __init__(self, name, waits=None, holds=None):
+        self.name = name
+        self.lock = Lock()
+        self.stats = _stats_for(name)
+        self.waits = waits
+        self.holds = holds
+        self._site = None
+        self._acquired_at = 0.0
+    
+    def __enter__(self):
+        site = _call_site()
+        waited = 0.0
+        contended = not self.lock.acquire(blocking=False)
+        if contended:
+            started = time.perf_counter()
+            self.lock.acquire()
+            waited = time.perf_counter() - started
+        now = time.perf_counter()
+        self._site = site
+        self._acquired_at = now
+        self.stats.acquired(site, waited, contended, now)
+        if self.waits is not None:
+            self.waits.observe(waited)
+        return self
+    
+    def __exit__(self, *exc_info):
+        held = time.perf_counter() - self._acquired_at
+        site = self._site
+        self.lock.release()
+        self.stats.released(site, held)
+        if self.holds is not None:
+            self.holds.observe(held)
+
+def report(limit=20):
+    """Per-lock totals with the current holders, and the `limit` hottest call sites"""
+    now = time.perf_counter()
+    locks = []
+    sites = []
+    with _stats_lock:
+        all_stats = list(_stats.values())
+    for lock_stats in all_stats:
+        with lock_stats.lock:
+            totals = _SiteStats()
+            for site, stats in lock_stats.sites.items():
+                totals.acquisitions += stats.acquisitions
+                totals.contended += stats.contended
+                totals.wait_total += stats.wait_total
+                totals.wait_max = max(totals.wait_max, stats.wait_max)
+                totals.hold_total += stats.hold_total
+                totals.hold_max = max(totals.hold_max, stats.hold_max)
+                sites.append(dict(stats.as_dict(), lock=lock_stats.name, site=_format_site(site)))
+            entry = dict(totals.as_dict(), lock=lock_stats.name, holder=None)
+            if lock_stats.holder is not None:
+                entry['holder'] = {'site': _format_site(lock_stats.holder),
+                                   'held_for': round(now - lock_stats.held_since, 6)}
+        locks.append(entry)
+    locks.sort(key=lambda entry: (-entry['wait_total'], -entry['hold_total']))
+    sites.sort(key=lambda entry: (-entry['wait_total'], -entry['hold_total']))
+    return {'locks': locks, 'sites': sites[:limit]}
+
+def reset():
+    """Forget the collected stats (current holders are kept)"""
+    with _stats_lock:
+        all_stats = list(_stats.values())
+    for lock_stats in all_stats:
+        with lock_stats.lock:
+            lock_stats.sites = {site: _SiteStats() for site in lock_stats.sites}
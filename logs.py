@@ -0,0 +1,157 @@
+"""
+Logging for RUCord
+
+Every subsystem logs through its own logger: get_logger('auth') is
+`rucord.auth`. The subsystems are auth, socket, call, http, messages,
+presence, storage and queue, plus socketio and engineio for the Socket.IO
+packet logs. Log calls only put records on a queue. A native thread
+(outside eventlet, so it never blocks the hub) formats them and writes
+them to stdout.
+
+Configured from the environment:
+
+- LOG_LEVEL: level of all subsystems (default INFO)
+- LOG_LEVELS: per subsystem levels, e.g. `socket=WARNING,call=DEBUG`.
+  socketio and engineio default to WARNING, so there is no per-packet
+  logging unless it is turned on here.
+- LOG_SAMPLE: share of DEBUG and INFO records kept per subsystem, for
+  high-frequency events, e.g. `socket=0.01`. Warnings and errors are
+  always kept.
+- LOG_FORMAT: `text` (default) or `json`, one JSON object per line.
+  Fields passed in `extra` are added to both.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import random
+import sys
+from datetime import datetime, timezone
+
+try:
+    from eventlet.patcher import original
+    _threading = original('threading')
+    _queue = original('queue')
+except ImportError:
+    import queue as _queue
+    import threading as _threading
+
+ROOT = 'rucord'
+
+# Levels used unless LOG_LEVELS says otherwise
+DEFAULT_LEVELS = {'socketio': 'WARNING', 'engineio': 'WARNING'}
+
+# LogRecord attributes, everything else on a record came from `extra`
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_writer = None
+
+def _parse_pairs(value):
+    """{'socket': 'WARNING'} for 'socket=WARNING,...'"""
+    pairs = {}
+    for pair in (value or '').split(','):
+        name, _, setting = pair.partition('=')
+        if name.strip() and setting.strip():
+            pairs[name.strip()] = setting.strip()
+    return pairs
+
+class SamplingFilter(logging.Filter):
+    """Keeps `rate` of the DEBUG and INFO records and every warning or error"""
+    
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+def _extra(record):
+    """Fields passed to the log call in `extra`"""
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+class TextFormatter(logging.Formatter):
+    """Plain text line with the `extra` fields appended as key=value"""
+    
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    
+    def formatMessage(self, record):
+        fields = ''.join(f' {key}={value}' for key, value in _extra(record).items())
+        return super().formatMessage(record) + fields
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record, with the `extra` fields"""
+    
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        data.update(_extra(record))
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class _Writer:
+    """Native thread writing queued records to a stream"""
+    
+    def __init__(self, formatter, stream):
+        self.formatter = formatter
+        self.stream = stream
+        self.queue = _queue.SimpleQueue()
+        self.thread = _threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self.thread.start()
+    
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            try:
+                self.stream.write(self.formatter.format(record) + '\n')
+                if self.queue.empty():
+                    self.stream.flush()
+            except Exception:
+                pass
+    
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Formatting happens on the writer thread; only fix the message and traceback now
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    """Configure the rucord loggers from the environment (only the first call does anything)"""
+    global _writer
+    if _writer is not None:
+        return
+    formatter = JSONFormatter() if os.environ.get('LOG_FORMAT', 'text') == 'json' else TextFormatter()
+    _writer = _Writer(formatter, sys.stdout)
+    atexit.register(_writer.stop)
+    
+    root = logging.getLogger(ROOT)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    root.addHandler(_QueueHandler(_writer.queue))
+    root.propagate = False
+    
+    levels = dict(DEFAULT_LEVELS, **_parse_pairs(os.environ.get('LOG_LEVELS')))
+    for name, level in levels.items():
+        logging.getLogger(f'{ROOT}.{name}').setLevel(level.upper())
+    for name, rate in _parse_pairs(os.environ.get('LOG_SAMPLE')).items():
+        logging.getLogger(f'{ROOT}.{name}').addFilter(SamplingFilter(float(rate)))
+
+def get_logger(subsystem):
+    """Logger of a subsystem, e.g. get_logger('auth')"""
+    setup_logging()
+    return logging.getLogger(f'{ROOT}.{subsystem}')
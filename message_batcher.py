@@ -0,0 +1,155 @@
+"""
+Coalesced message sending for RUCord
+
+Messages sent over the socket (send_message) go through a queue drained
+by one background task. It waits `window` seconds after the first
+message so a burst can gather, stores the whole batch with a single
+storage.add_many call (one lock, one journal or segment write, one
+fsync) and broadcasts it with one event per room.
+
+Every send carries a client-generated nonce. A repeated nonce (a retry
+after a lost ack, or an HTTP fallback) returns the message already
+stored for it instead of storing it twice. Queue and events come from
+the Socket.IO async driver, so this works with and without eventlet
+monkey patching.
+"""
+from collections import OrderedDict
+
+from logs import get_logger
+
+log = get_logger('messages')
+
+# Client nonces are UUIDs; anything else is refused before it is used as a key
+MAX_NONCE_LENGTH = 64
+
+def valid_nonce(nonce):
+    """Whether a nonce from a request is usable: absent or a short string"""
+    return nonce is None or (isinstance(nonce, str) and len(nonce) <= MAX_NONCE_LENGTH)
+
+class _Pending:
+    """One queued message and the event its sender waits on"""
+    
+    def __init__(self, item, event, rooms, done):
+        self.item = item
+        self.event = event
+        self.rooms = rooms
+        self.done = done
+        self.message = None
+        self.error = None
+
+class MessageBatcher:
+    """Queue of messages stored and broadcast in batches"""
+    
+    def __init__(self, socketio, storage, format_messages, window=0.005, max_batch=200, max_nonces=10000,
+                 on_stored=None):
+        self.socketio = socketio
+        self.storage = storage
+        self.format_messages = format_messages
+        # Called with the stored batch before it is broadcast
+        self.on_stored = on_stored
+        self.window = window
+        self.max_batch = max_batch
+        self.max_nonces = max_nonces
+        self.queue = None
+        # (user_id, nonce) -> _Pending, oldest first
+        self.nonces = OrderedDict()
+    
+    def _eio(self):
+        return self.socketio.server.eio
+    
+    def _start(self):
+        if self.queue is None:
+            self.queue = self._eio().create_queue()
+            self.socketio.start_background_task(self._run)
+    
+    def _remember(self, user_id, nonce, pending):
+        """Pending send already registered for the nonce, or None after registering this one"""
+        if not nonce:
+            return None
+        known = self.nonces.setdefault((user_id, nonce), pending)
+        if known is not pending:
+            return known
+        while len(self.nonces) > self.max_nonces:
+            self.nonces.popitem(last=False)
+        return None
+    
+    def recall(self, user_id, nonce):
+        """Message already stored for a nonce (waiting if its batch is in flight), or None"""
+        pending = self.nonces.get((user_id, nonce)) if nonce else None
+        if pending is None:
+            return None
+        pending.done.wait()
+        return pending.message
+    
+    def remember(self, user_id, nonce, message):
+        """Record a message stored outside the batcher (HTTP API) under its nonce"""
+        done = self._eio().create_event()
+        done.set()
+        pending = _Pending(None, None, None, done)
+        pending.message = message
+        self._remember(user_id, nonce, pending)
+    
+    def send(self, item, event, rooms, nonce=None):
+        """Store a message and emit `event` with it to `rooms`.
+        
+        Blocks until the batch holding the message is committed and
+        returns the formatted message.
+        """
+        self._start()
+        pending = _Pending(item, event, rooms, self._eio().create_event())
+        known = self._remember(item['user_id'], nonce, pending)
+        if known is not None:
+            known.done.wait()
+            if known.error is None:
+                return known.message
+            # The earlier attempt failed, try again with this one
+            self.nonces[(item['user_id'], nonce)] = pending
+        self.queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.message
+    
+    def _run(self):
+        empty = self._eio().get_queue_empty_exception()
+        while True:
+            batch = [self.queue.get()]
+            if self.window:
+                self.socketio.sleep(self.window)
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except empty:
+                    break
+            self._flush(batch)
+    
+    def _flush(self, batch):
+        try:
+            stored = self.storage.add_many('messages', [pending.item for pending in batch])
+            messages = self.format_messages(stored)
+        except Exception as e:
+            log.error('Storing a batch of %d failed: %s', len(batch), e)
+            for pending in batch:
+                pending.error = e
+                pending.done.set()
+            return
+        
+        if self.on_stored is not None:
+            try:
+                self.on_stored(stored)
+            except Exception as e:
+                # The messages are stored; failing the sends would make clients store them again
+                log.exception('Post-store hook failed: %s', e)
+        
+        # One emit per set of rooms; a list of rooms reaches each client once
+        broadcasts = OrderedDict()
+        for pending, message in zip(batch, messages):
+            pending.message = message
+            broadcasts.setdefault((pending.event, tuple(pending.rooms)), []).append(message)
+        for (event, rooms), payload in broadcasts.items():
+            try:
+                self.socketio.emit(event, payload, to=list(rooms))
+            except Exception as e:
+                log.error('Broadcast of %s failed: %s', event, e)
+        for pending in batch:
+            pending.done.set()
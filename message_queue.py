@@ -0,0 +1,192 @@
+"""
+Socket.IO message queue for running RUCord on several workers or hosts
+
+socketio.emit(..., room=...) only reaches clients connected to the same
+process. With SOCKETIO_MESSAGE_QUEUE set, every emit is also published to
+a message queue and each worker delivers it to its own clients:
+
+- not set: single process, emits stay local
+- local://host:port: the bundled broker below, started with
+  python message_queue.py broker [host:port]
+- redis://, amqp://, kafka://, zmq+tcp://: handled by Flask-SocketIO
+  (needs the matching client package)
+
+The local broker is a plain TCP relay meant for a single host, tests and
+benchmarks. Messages are pickled like in the other python-socketio
+backends, so bind it only to a trusted interface.
+"""
+import pickle
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+import socketio
+
+from logs import get_logger
+
+DEFAULT_LOCAL_ADDRESS = ('127.0.0.1', 5557)
+
+_HEADER = struct.Struct('>I')
+
+log = get_logger('queue')
+
+def _frame(payload):
+    return _HEADER.pack(len(payload)) + payload
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def _read_frames(sock):
+    """Yield length-prefixed payloads until the connection closes"""
+    while True:
+        header = _recv_exact(sock, _HEADER.size)
+        if header is None:
+            return
+        payload = _recv_exact(sock, _HEADER.unpack(header)[0])
+        if payload is None:
+            return
+        yield payload
+
+def parse_local_url(url):
+    """(host, port) of a local://host:port URL"""
+    address = url[len('local://'):].strip('/')
+    if not address:
+        return DEFAULT_LOCAL_ADDRESS
+    host, _, port = address.rpartition(':')
+    return (host or DEFAULT_LOCAL_ADDRESS[0], int(port))
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    """One connection: a publisher (role b'P') or a subscriber (role b'S')"""
+    
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        role = _recv_exact(sock, 1)
+        if role == b'S':
+            self.server.subscribe(sock)
+            try:
+                # Subscribers never send; this returns when they disconnect
+                while sock.recv(1024):
+                    pass
+            except OSError:
+                pass
+            finally:
+                self.server.unsubscribe(sock)
+        elif role == b'P':
+            for payload in _read_frames(sock):
+                self.server.publish(_frame(payload))
+
+class LocalBroker(socketserver.ThreadingTCPServer):
+    """Relays every published frame to every subscriber, in one global order"""
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, address=DEFAULT_LOCAL_ADDRESS):
+        super().__init__(address, _BrokerHandler)
+        self.subscribers = set()
+        self.lock = threading.Lock()
+    
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'local://{host}:{port}'
+    
+    def subscribe(self, sock):
+        with self.lock:
+            self.subscribers.add(sock)
+    
+    def unsubscribe(self, sock):
+        with self.lock:
+            self.subscribers.discard(sock)
+    
+    def publish(self, frame):
+        with self.lock:
+            for sock in list(self.subscribers):
+                try:
+                    sock.sendall(frame)
+                except OSError:
+                    self.subscribers.discard(sock)
+    
+    def start(self):
+        """Serve from a daemon thread (for tests and benchmarks)"""
+        threading.Thread(target=self.serve_forever, name='socketio-broker', daemon=True).start()
+        return self
+
+class LocalQueueManager(socketio.PubSubManager):
+    """python-socketio client manager backed by LocalBroker"""
+    name = 'local'
+    
+    def __init__(self, url='local://', channel='flask-socketio', write_only=False, logger=None):
+        self.address = parse_local_url(url)
+        self.publisher = None
+        self.publish_lock = threading.Lock()
+        self.socket = socket
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+    
+    def initialize(self):
+        if getattr(self.server, 'async_mode', None) == 'eventlet':
+            # Green sockets even when the process is not monkey patched
+            from eventlet.green import socket as green_socket
+            from eventlet.semaphore import Semaphore
+            self.socket = green_socket
+            self.publish_lock = Semaphore()
+        super().initialize()
+    
+    def _connect(self, role):
+        sock = self.socket.create_connection(self.address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(role)
+        return sock
+    
+    def _publish(self, data):
+        frame = _frame(pickle.dumps({'channel': self.channel, 'data': data}))
+        with self.publish_lock:
+            # Retry once on a fresh connection if the broker was restarted
+            for attempt in range(2):
+                try:
+                    if self.publisher is None:
+                        self.publisher = self._connect(b'P')
+                    self.publisher.sendall(frame)
+                    return
+                except OSError:
+                    self.publisher = None
+                    if attempt:
+                        raise
+    
+    def _listen(self):
+        while True:
+            try:
+                sock = self._connect(b'S')
+                for payload in _read_frames(sock):
+                    message = pickle.loads(payload)
+                    if message.get('channel') == self.channel:
+                        yield message['data']
+                log.warning('Broker closed the connection, reconnecting')
+            except OSError as e:
+                log.warning('Broker unavailable (%s), retrying', e)
+            self.server.sleep(1)
+
+def socketio_queue_options(url):
+    """SocketIO keyword arguments for a SOCKETIO_MESSAGE_QUEUE URL"""
+    if not url:
+        return {}
+    if url.startswith('local://'):
+        return {'client_manager': LocalQueueManager(url)}
+    return {'message_queue': url}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'broker':
+        print('Usage: python message_queue.py broker [host:port]')
+        sys.exit(1)
+    address = parse_local_url('local://' + sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_LOCAL_ADDRESS
+    broker = LocalBroker(address)
+    print(f"[QUEUE] Broker listening on {broker.url}")
+    broker.serve_forever()
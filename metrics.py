@@ -0,0 +1,261 @@
+"""
+Prometheus-style metrics for RUCord
+
+A small in-process registry of counters, gauges and histograms rendered
+in the Prometheus text format at GET /metrics. Recording a value is a
+dictionary lookup, a bisect and a few additions under a per-series lock,
+so the metrics stay on in production.
+
+- rucord_http_request_seconds{method, route}: Flask request latency,
+  route being the URL rule (/api/channels/<int:channel_id>/messages)
+- rucord_http_requests_total{method, route, status}
+- rucord_socketio_event_seconds{event}: Socket.IO handler latency
+- rucord_socketio_connected_clients, rucord_socketio_rooms: sockets and
+  named rooms (channels, DMs, user rooms) of this process
+- rucord_socketio_emit_recipients: clients each emit reached in this
+  process (its fan-out)
+- rucord_storage_seconds{collection, op} and
+  rucord_storage_bytes_total{collection, op}: JSONStorage file reads,
+  parsing, writes, lock waits and lock holds (see storage.py), and
+  rucord_storage_fsync_seconds for group commit flushes
+
+Each process keeps its own metrics, so with several workers every one
+has to be scraped.
+"""
+import time
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+
+# Seconds, from a resident dict lookup to a slow fsync
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Recipients of one emit
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _CounterChild:
+    def __init__(self):
+        self.lock = Lock()
+        self.value = 0
+    
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.lock = Lock()
+        self.buckets = buckets
+        # counts[i] observations fell into buckets[i] (the last one is +Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+    
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+class _Metric:
+    kind = None
+    
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        # label values -> child
+        self.children = {}
+    
+    def _new_child(self):
+        raise NotImplementedError
+    
+    def labels(self, *values):
+        """Series for the label values (created on first use)"""
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            children = list(self.children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+    
+    def _new_child(self):
+        return _CounterChild()
+    
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+    
+    def _render_child(self, values, child):
+        return [f'{self.name}{_labels(self.labelnames, values)} {_number(child.value)}']
+
+class Histogram(_Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+    
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+    
+    def observe(self, value):
+        self.labels().observe(value)
+    
+    def _render_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = 'le="' + _number(bound) + '"'
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, values, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels(self.labelnames, values)} {_number(total)}')
+        lines.append(f'{self.name}_count{_labels(self.labelnames, values)} {cumulative}')
+        return lines
+
+class Gauge(_Metric):
+    """Gauge read from a function at scrape time"""
+    kind = 'gauge'
+    
+    def __init__(self, name, help, function):
+        super().__init__(name, help)
+        self.function = function
+    
+    def render(self):
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {_number(value)}']
+
+class Registry:
+    """Metrics rendered together at /metrics"""
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+    
+    def _register(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+    
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+    
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+    
+    def gauge(self, name, help, function):
+        return self._register(Gauge(name, help, function))
+    
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def instrument_flask(app):
+    """Time every Flask request by method and URL rule"""
+    from flask import g, request
+    
+    seconds = histogram('rucord_http_request_seconds', 'Flask request latency', ('method', 'route'))
+    requests = counter('rucord_http_requests_total', 'Flask requests', ('method', 'route', 'status'))
+    
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+    
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            seconds.labels(request.method, route).observe(time.perf_counter() - started)
+            requests.labels(request.method, route, str(response.status_code)).inc()
+        return response
+
+def instrument_socketio(socketio, namespace='/'):
+    """Time the Socket.IO handlers registered so far, count clients, rooms and emit fan-out.
+    
+    Call it after the last @socketio.on handler is defined.
+    """
+    server = socketio.server
+    seconds = histogram('rucord_socketio_event_seconds', 'Socket.IO handler latency', ('event',))
+    
+    def timed(event, handler):
+        series = seconds.labels(event)
+        
+        @wraps(handler)
+        def wrapper(*args):
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                series.observe(time.perf_counter() - started)
+        return wrapper
+    
+    handlers = server.handlers.get(namespace, {})
+    for event, handler in list(handlers.items()):
+        handlers[event] = timed(event, handler)
+    
+    def clients():
+        return len(server.manager.rooms.get(namespace, {}).get(None, ()))
+    
+    def rooms():
+        ns = server.manager.rooms.get(namespace, {})
+        sids = ns.get(None, {})
+        # Every client also sits in a room named after its sid
+        return sum(1 for room in ns if room is not None and room not in sids)
+    
+    gauge('rucord_socketio_connected_clients', 'Socket.IO clients connected to this process', clients)
+    gauge('rucord_socketio_rooms', 'Named Socket.IO rooms in this process', rooms)
+    
+    recipients = histogram('rucord_socketio_emit_recipients', 'Clients reached by one emit in this process',
+                           buckets=FANOUT_BUCKETS)
+    get_participants = server.manager.get_participants
+    
+    # Every emit, local or relayed by the message queue, lists its recipients once
+    def counted_participants(namespace, room):
+        count = 0
+        for participant in get_participants(namespace, room):
+            count += 1
+            yield participant
+        recipients.observe(count)
+    
+    server.manager.get_participants = counted_participants
@@ -0,0 +1,71 @@
+"""
+Password hashing off the event loop for RUCord
+
+bcrypt takes 100-300 ms of CPU per hash or check at the default work
+factor. Called inline in an eventlet worker it blocks the hub, and with
+it every WebSocket of the process, for the whole time. PasswordPool runs
+the work on a few native threads instead (eventlet.tpool under eventlet,
+a thread pool otherwise); bcrypt releases the GIL while hashing, so the
+hub keeps serving other clients and several hashes run in parallel.
+
+The pool accepts at most `max_pending` jobs at a time (running and
+waiting). Beyond that it raises PasswordPoolBusy right away, and the
+login or registration is answered with 503 instead of queueing without
+bound during a login storm.
+
+The work factor comes from BCRYPT_ROUNDS. Hashes made with another work
+factor keep working; needs_rehash() tells when to replace one after a
+successful login.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import hash_password, check_password, BCRYPT_ROUNDS
+
+class PasswordPoolBusy(Exception):
+    """Too many password jobs are already running or waiting"""
+
+def needs_rehash(password_hash):
+    """Whether a bcrypt hash was made with another work factor than BCRYPT_ROUNDS"""
+    try:
+        return int(password_hash.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+class PasswordPool:
+    """Bounded pool of native threads for bcrypt work"""
+    
+    def __init__(self, workers=4, max_pending=64, green=False):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.green = green
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        if green:
+            from eventlet import tpool
+            # Takes effect when tpool starts its threads on first use
+            tpool.set_num_threads(workers)
+            self._tpool = tpool
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+    
+    def _run(self, function, *args):
+        with self.pending_lock:
+            if self.pending >= self.max_pending:
+                raise PasswordPoolBusy()
+            self.pending += 1
+        try:
+            if self.green:
+                return self._tpool.execute(function, *args)
+            return self._executor.submit(function, *args).result()
+        finally:
+            with self.pending_lock:
+                self.pending -= 1
+    
+    def hash(self, password):
+        """Hash a password on the pool"""
+        return self._run(hash_password, password)
+    
+    def check(self, password, password_hash):
+        """Check a password against its hash on the pool"""
+        return self._run(check_password, password, password_hash)
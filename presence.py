@@ -0,0 +1,279 @@
+"""
+Presence fan-out for RUCord
+
+A status change is sent only to the users who can see it: the user's own
+sessions, friends, DM partners and members of shared servers. Each
+user's audience is computed once and cached until a friendship, DM
+channel or server membership involving the user changes (or the cache
+entry expires, which bounds staleness when several workers serve the
+same users). All rooms of an audience are addressed in one emit, so the
+event is encoded and published to the message queue once.
+
+Presence itself lives only in memory. Every Socket.IO session of a
+user is registered here, so a second tab closing does not take the user
+offline; the user is online while at least one session is left. Sessions
+that stop sending heartbeats are expired, in case a disconnect was never
+delivered. The users table only keeps the status the user chose (online,
+idle, dnd, offline for invisible), so connects and disconnects cost no
+disk I/O.
+
+With several workers (`shared`) each one also records which users it has
+sessions for in the `presence` collection: a row when a user's first
+session on the worker connects, deleted after the last one is gone, plus
+a lease row per worker renewed by its sweeper. Other workers read these
+rows at most every `shared_refresh` seconds, so a user connected anywhere
+shows as online everywhere. Rows of a worker whose lease is older than
+`heartbeat_timeout` (it was stopped or crashed) are ignored and deleted.
+
+Going offline is debounced: a user who reconnects within `debounce`
+seconds (page reload, flaky network) never appears offline to others.
+
+Published changes are numbered, so /api/sync can tell which users changed
+status after a cursor. The numbering restarts with the process (the epoch
+tells them apart).
+"""
+import time
+import uuid
+from threading import Lock
+
+from logs import get_logger
+
+log = get_logger('presence')
+
+class Presence:
+    """Session registry, audience cache, status de-duplication and offline debounce"""
+    
+    def __init__(self, socketio, storage, format_user, debounce=5.0, audience_ttl=60.0, heartbeat_timeout=90.0,
+                 shared=False, shared_refresh=2.0):
+        self.socketio = socketio
+        self.storage = storage
+        self.format_user = format_user
+        self.debounce = debounce
+        self.audience_ttl = audience_ttl
+        self.heartbeat_timeout = heartbeat_timeout
+        self.lock = Lock()
+        # user_id -> {sid: time of the last heartbeat}
+        self.sessions = {}
+        self.sweeping = False
+        # user_id -> (expires_at, frozenset of user ids)
+        self.audiences = {}
+        # Bumped by invalidate() so a lookup racing with it is not cached
+        self.generation = 0
+        # user_id -> last (status, status_message) sent to the audience
+        self.published = {}
+        # user_id -> token of the scheduled offline transition
+        self.pending = {}
+        # user_id -> number of the last published change, see cursor()
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.versions = {}
+        # Shared presence; the epoch doubles as the worker id
+        self.shared = shared
+        self.shared_refresh = shared_refresh
+        self.lease_id = None
+        # user_id -> id of the user's row in `presence`
+        self.shared_rows = {}
+        # Users with sessions on other workers, and when that was read
+        self.elsewhere = frozenset()
+        self.elsewhere_at = None
+    
+    def _compute_audience(self, user_id):
+        user_ids = {user_id}
+        for collection in ('friendships', 'dm_channels'):
+            for row in self.storage.get_by_field(collection, 'user1_id', user_id):
+                user_ids.add(row['user2_id'])
+            for row in self.storage.get_by_field(collection, 'user2_id', user_id):
+                user_ids.add(row['user1_id'])
+        for membership in self.storage.get_by_field('server_members', 'user_id', user_id):
+            for member in self.storage.get_by_field('server_members', 'server_id', membership['server_id']):
+                user_ids.add(member['user_id'])
+        return frozenset(user_ids)
+    
+    def audience(self, user_id):
+        """IDs of the users who see user_id's status, including user_id"""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.audiences.get(user_id)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+            generation = self.generation
+        audience = self._compute_audience(user_id)
+        with self.lock:
+            if self.generation == generation:
+                self.audiences[user_id] = (now + self.audience_ttl, audience)
+        return audience
+    
+    def invalidate(self, *user_ids):
+        """Forget the audiences of users whose relations changed"""
+        with self.lock:
+            self.generation += 1
+            for user_id in user_ids:
+                self.audiences.pop(user_id, None)
+    
+    def status_changed(self, user_id, user_dict):
+        """Send user_status_changed to the user's audience unless nothing visible changed"""
+        key = (user_dict.get('status'), user_dict.get('status_message'))
+        with self.lock:
+            if self.published.get(user_id) == key:
+                return
+            self.published[user_id] = key
+            self.version += 1
+            self.versions[user_id] = self.version
+        rooms = [f'user_{uid}' for uid in sorted(self.audience(user_id))]
+        self.socketio.emit('user_status_changed', user_dict, to=rooms, namespace='/')
+    
+    def cursor(self):
+        """(epoch, version) after the last published change"""
+        with self.lock:
+            return (self.epoch, self.version)
+    
+    def changed_since(self, user_ids, cursor):
+        """Users among user_ids whose status was published after a cursor (all of them for another epoch)"""
+        epoch, version = cursor
+        with self.lock:
+            if epoch != self.epoch:
+                return list(user_ids)
+            return [user_id for user_id in user_ids if self.versions.get(user_id, 0) > version]
+    
+    def publish(self, user_id):
+        """Send the user's current visible status to its audience"""
+        user = self.storage.get_by_id('users', user_id)
+        if user:
+            if self.shared:
+                # Another worker may have published a change since
+                with self.lock:
+                    self.published.pop(user_id, None)
+            self.status_changed(user_id, self.format_user(user))
+    
+    def is_online(self, user_id):
+        """True while the user has a session here or on another worker (or just lost the last one)"""
+        with self.lock:
+            if self.sessions.get(user_id) or user_id in self.pending:
+                return True
+        return self.shared and user_id in self._online_elsewhere()
+    
+    def _online_elsewhere(self, refresh=False):
+        """Users with sessions on other live workers, read from `presence` every shared_refresh seconds"""
+        now = time.monotonic()
+        with self.lock:
+            if not refresh and self.elsewhere_at is not None and now - self.elsewhere_at < self.shared_refresh:
+                return self.elsewhere
+        rows = self.storage.get_all('presence')
+        deadline = time.time() - self.heartbeat_timeout
+        live = {row['worker'] for row in rows if row.get('user_id') is None and row.get('seen', 0) > deadline}
+        elsewhere = frozenset(row['user_id'] for row in rows
+                              if row.get('user_id') is not None and row['worker'] in live and row['worker'] != self.epoch)
+        for worker in {row['worker'] for row in rows} - live - {self.epoch}:
+            log.info('Dropping the presence of stopped worker %s', worker)
+            self.storage.delete_by_field('presence', 'worker', worker)
+        with self.lock:
+            self.elsewhere = elsewhere
+            self.elsewhere_at = now
+        return elsewhere
+    
+    def _renew_lease(self):
+        """Create or renew this worker's lease row"""
+        lease = {'worker': self.epoch, 'user_id': None, 'seen': time.time()}
+        if self.lease_id is not None and self.storage.update('presence', self.lease_id, lease) is not None:
+            return
+        # First lease, or another worker took this one for dead and dropped our rows
+        self.lease_id = self.storage.add('presence', lease)['id']
+        with self.lock:
+            user_ids = list(self.shared_rows)
+        for user_id in user_ids:
+            self._share_online(user_id)
+    
+    def _share_online(self, user_id):
+        row = self.storage.add('presence', {'worker': self.epoch, 'user_id': user_id})
+        with self.lock:
+            self.shared_rows[user_id] = row['id']
+    
+    def _share_offline(self, user_id):
+        with self.lock:
+            row_id = self.shared_rows.pop(user_id, None)
+        if row_id is not None:
+            self.storage.delete('presence', row_id)
+    
+    def visible_status(self, user):
+        """Status others see: the chosen status while connected, offline otherwise"""
+        if not self.is_online(user['id']):
+            return 'offline'
+        return user.get('status') or 'online'
+    
+    def connect(self, user_id, sid):
+        """Register a session and publish the status if the user came online"""
+        with self.lock:
+            sessions = self.sessions.setdefault(user_id, {})
+            # A reconnect within the debounce period changes nothing for others
+            came_online = not sessions and self.pending.pop(user_id, None) is None
+            sessions[sid] = time.monotonic()
+            start_sweeper = not self.sweeping
+            self.sweeping = True
+        if self.shared and start_sweeper:
+            self._renew_lease()
+        if start_sweeper:
+            self.socketio.start_background_task(self._sweep)
+        if came_online:
+            if self.shared:
+                self._share_online(user_id)
+            self.publish(user_id)
+    
+    def heartbeat(self, user_id, sid):
+        """Mark a session as alive"""
+        with self.lock:
+            sessions = self.sessions.get(user_id)
+            if sessions is not None and sid in sessions:
+                sessions[sid] = time.monotonic()
+    
+    def disconnect(self, user_id, sid):
+        """Drop a session; after the last one the user goes offline once the debounce period passes"""
+        token = object()
+        with self.lock:
+            sessions = self.sessions.get(user_id)
+            if sessions is None or sessions.pop(sid, None) is None or sessions:
+                return
+            del self.sessions[user_id]
+            self.pending[user_id] = token
+        self.socketio.start_background_task(self._expire, user_id, token)
+    
+    def _expire(self, user_id, token):
+        self.socketio.sleep(self.debounce)
+        with self.lock:
+            if self.pending.get(user_id) is not token:
+                return
+            del self.pending[user_id]
+        self._went_offline(user_id)
+    
+    def _went_offline(self, user_id):
+        try:
+            if self.shared:
+                self._share_offline(user_id)
+                # Still connected to another worker: nothing changed for others
+                if user_id in self._online_elsewhere(refresh=True):
+                    return
+            self.publish(user_id)
+        except Exception as e:
+            log.error('Offline update for user %s failed: %s', user_id, e)
+    
+    def _sweep(self):
+        """Expire sessions that stopped sending heartbeats"""
+        while True:
+            self.socketio.sleep(self.heartbeat_timeout / 3)
+            if self.shared:
+                try:
+                    self._renew_lease()
+                except Exception as e:
+                    log.error('Presence lease renewal failed: %s', e)
+            deadline = time.monotonic() - self.heartbeat_timeout
+            expired = []
+            with self.lock:
+                for user_id, sessions in list(self.sessions.items()):
+                    for sid, seen in list(sessions.items()):
+                        if seen < deadline:
+                            del sessions[sid]
+                    if not sessions:
+                        del self.sessions[user_id]
+                        expired.append(user_id)
+            for user_id in expired:
+                log.info('Sessions of user %s expired', user_id)
+                self._went_offline(user_id)
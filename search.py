@@ -0,0 +1,260 @@
+"""
+Message and user search for RUCord
+
+MessageIndex is an in-memory inverted index: word -> ids of the messages
+containing it, plus the channel or DM of every indexed message. Words are
+lowercased, ё is folded into е and common Russian endings are cut off, so
+"сообщения" finds "сообщение". The last word of a query also matches as
+a prefix, for search-as-you-type.
+
+UserIndex keeps usernames sorted (prefix matches by binary search) and
+a bigram/trigram index (a substring match shares every n-gram with the
+query, so only the users under its rarest n-gram are checked).
+
+New items are added as they are stored. Before every search an index also
+catches up with items it has not seen (the first search indexes
+everything, other workers' writes arrive this way), reading only ids
+above the last one it knows. A search touches only the posting lists of
+its query, so its cost grows with the number of matches, not with the
+size of the collection.
+"""
+import re
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from threading import Lock
+
+_WORD = re.compile(r'\w+')
+
+# Longest first, so "ами" is cut before "и"
+_ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ией',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ой', 'ей', 'ий', 'ый', 'ом', 'ем', 'ам', 'ям',
+    'ах', 'ях', 'ов', 'ев', 'ую', 'юю', 'ия', 'ию',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й'
+), key=len, reverse=True)
+
+def normalize(text):
+    """Lowercase text with ё folded into е"""
+    return text.lower().replace('ё', 'е')
+
+def _stem(word):
+    """Word without a common Russian ending, keeping at least 3 letters"""
+    if len(word) > 3 and 'а' <= word[-1] <= 'я':
+        for ending in _ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                return word[:-len(ending)]
+    return word
+
+def words(text):
+    """Normalized words of 2+ characters"""
+    return [word for word in _WORD.findall(normalize(text)) if len(word) > 1]
+
+def tokenize(text):
+    """Search terms of a text: stemmed words"""
+    return [_stem(word) for word in words(text)]
+
+def message_scope(message):
+    """Channel or DM a message belongs to: ('channel_id', id) or ('dm_channel_id', id)"""
+    if message.get('channel_id'):
+        return ('channel_id', message['channel_id'])
+    return ('dm_channel_id', message.get('dm_channel_id'))
+
+class _Index:
+    """In-memory index of a storage collection that catches up by id"""
+    collection = None
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = Lock()
+        self.catch_up_lock = Lock()
+        # id -> what the index keeps about the item
+        self.indexed = {}
+        # Every item with an id up to this one is indexed
+        self.indexed_up_to = 0
+    
+    def add(self, items):
+        """Index newly stored items"""
+        with self.lock:
+            for item in items:
+                self._add(item)
+            while self.indexed_up_to + 1 in self.indexed:
+                self.indexed_up_to += 1
+    
+    def _add(self, item):
+        if item['id'] not in self.indexed:
+            self.indexed[item['id']] = self._index(item)
+    
+    def _index(self, item):
+        raise NotImplementedError
+    
+    def catch_up(self):
+        """Index items stored since the last catch-up (by any process)"""
+        with self.catch_up_lock:
+            last_id = self.storage.get_last_id(self.collection)
+            if last_id <= self.indexed_up_to:
+                return
+            items = self.storage.get_after(self.collection, self.indexed_up_to)
+            with self.lock:
+                for item in items:
+                    self._add(item)
+                self.indexed_up_to = max(self.indexed_up_to, last_id)
+
+class MessageIndex(_Index):
+    """Inverted index over message contents"""
+    collection = 'messages'
+    
+    def __init__(self, storage, max_prefix_terms=50):
+        super().__init__(storage)
+        self.max_prefix_terms = max_prefix_terms
+        # term -> sorted message ids
+        self.postings = {}
+        # sorted terms, for prefix lookups
+        self.terms = []
+    
+    def _index(self, message):
+        """Post the message under its terms; the index keeps its scope"""
+        message_id = message['id']
+        for term in set(tokenize(message.get('content') or '')):
+            ids = self.postings.get(term)
+            if ids is None:
+                self.postings[term] = [message_id]
+                insort(self.terms, term)
+            elif ids[-1] < message_id:
+                ids.append(message_id)
+            else:
+                insort(ids, message_id)
+        return message_scope(message)
+    
+    def _expand(self, prefix):
+        """Indexed terms starting with prefix, at most max_prefix_terms of them"""
+        start = bisect_left(self.terms, prefix)
+        matches = []
+        for term in self.terms[start:start + self.max_prefix_terms]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return matches
+    
+    def search(self, query, scopes, limit, offset=0):
+        """Ranked ids of messages in `scopes` matching query, and the total match count.
+        
+        Messages matching more query words rank higher, newer ones first
+        among equals.
+        """
+        self.catch_up()
+        query_words = words(query)
+        if not query_words:
+            return [], 0
+        terms = list(dict.fromkeys(_stem(word) for word in query_words[:-1]))
+        last_term = _stem(query_words[-1])
+        if last_term in terms:
+            terms.remove(last_term)
+        terms.append(last_term)
+        # The last word may still be being typed
+        last_prefix = query_words[-1]
+        
+        scores = {}
+        with self.lock:
+            for position, term in enumerate(terms):
+                matched = set(self.postings.get(term, ()))
+                if position == len(terms) - 1:
+                    for expanded in self._expand(last_prefix):
+                        matched.update(self.postings[expanded])
+                for message_id in matched:
+                    if self.indexed.get(message_id) in scopes:
+                        scores[message_id] = scores.get(message_id, 0) + 1
+        
+        ranked = sorted(scores, key=lambda message_id: (-scores[message_id], -message_id))
+        return ranked[offset:offset + limit], len(ranked)
+    
+    def fetch(self, message_ids):
+        """Stored messages for ids returned by search(), in the same order"""
+        messages = []
+        for message_id in message_ids:
+            field, value = self.indexed[message_id]
+            # The newest message of its channel up to the id is the message itself
+            page = self.storage.get_page('messages', field, value, 1, before=message_id + 1)[0]
+            if page and page[0]['id'] == message_id:
+                messages.append(page[0])
+        return messages
+
+def _grams(name, size):
+    return {name[i:i + size] for i in range(len(name) - size + 1)}
+
+class UserIndex(_Index):
+    """Prefix and n-gram index over usernames, with a short-lived query cache"""
+    collection = 'users'
+    
+    def __init__(self, storage, cache_ttl=10.0, cache_size=1000, max_candidates=500):
+        super().__init__(storage)
+        self.max_candidates = max_candidates
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # sorted (normalized username, user id)
+        self.names = []
+        # bigram or trigram -> user ids
+        self.grams = {}
+        # (query, user_id) -> (expires_at, ranked user ids), oldest first
+        self.cache = OrderedDict()
+    
+    def _index(self, user):
+        """Index the username; the index keeps it normalized"""
+        name = normalize(user.get('username') or '')
+        insort(self.names, (name, user['id']))
+        for gram in _grams(name, 2) | _grams(name, 3):
+            self.grams.setdefault(gram, set()).add(user['id'])
+        # A cached query might have matched the new user
+        self.cache.clear()
+        return name
+    
+    def _matches(self, query):
+        """Ids of users whose username contains query, prefix matches first, at most max_candidates"""
+        start = bisect_left(self.names, (query,))
+        matches = []
+        for name, user_id in self.names[start:start + self.max_candidates]:
+            if not name.startswith(query):
+                break
+            matches.append(user_id)
+        
+        # Substring matches share every n-gram with the query; scan the rarest one
+        rarest = min((self.grams.get(gram, set()) for gram in _grams(query, min(len(query), 3))), key=len)
+        for user_id in rarest:
+            if len(matches) >= self.max_candidates:
+                break
+            name = self.indexed[user_id]
+            if query in name and not name.startswith(query):
+                matches.append(user_id)
+        return matches
+    
+    def search(self, query, user_id, limit, related=None):
+        """Ids of up to `limit` users matching query, best first, without user_id.
+        
+        Exact and prefix matches come first, then users in the set returned
+        by related() (friends of friends), then shorter names. Repeated
+        queries within cache_ttl seconds are answered from the cache.
+        """
+        query = normalize(query.strip())
+        key = (query, user_id)
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1][:limit]
+        
+        self.catch_up()
+        related = related() if related is not None else set()
+        with self.lock:
+            matches = [uid for uid in self._matches(query) if uid != user_id]
+            ranked = sorted(matches, key=lambda uid: (
+                self.indexed[uid] != query,
+                not self.indexed[uid].startswith(query),
+                uid not in related,
+                len(self.indexed[uid]),
+                self.indexed[uid]
+            ))
+            self.cache[key] = (now + self.cache_ttl, ranked)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ranked[:limit]
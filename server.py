@@ -1,11 +1,31 @@
-from flask import Flask, render_template, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, g
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, decode_token
+from flask_jwt_extended.exceptions import NoAuthorizationError, InvalidHeaderError, WrongTokenError
 from datetime import datetime, timedelta
+from functools import wraps
+from threading import Lock
+import hmac
 import os
-import jwt as pyjwt
-from storage import storage, hash_password, check_password
+import time
+from storage import storage, hash_password
+from passwords import PasswordPool, PasswordPoolBusy, needs_rehash
+from message_queue import socketio_queue_options
+from presence import Presence
+from message_batcher import MessageBatcher, valid_nonce
+from changelog import ChangeLog, make_sync_token, parse_sync_token
+from search import MessageIndex, UserIndex
+from token_cache import TokenCache
+from logs import get_logger
+import metrics
+import locks
+
+auth_log = get_logger('auth')
+socket_log = get_logger('socket')
+call_log = get_logger('call')
+storage_log = get_logger('storage')
+http_log = get_logger('http')
 
 # ==================== FLASK APP ====================
 
@@ -15,17 +35,98 @@ app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'jwt-secret-key-
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=30)
 
 jwt = JWTManager(app)
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', logger=True, engineio_logger=True)
+# SOCKETIO_MESSAGE_QUEUE lets emits reach clients of other workers and hosts
+# Packet logs go to the socketio and engineio loggers, WARNING unless LOG_LEVELS says otherwise
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet',
+                    logger=get_logger('socketio'), engineio_logger=get_logger('engineio'),
+                    **socketio_queue_options(os.environ.get('SOCKETIO_MESSAGE_QUEUE')))
 CORS(app)
+metrics.instrument_flask(app)
+
+# Online state of connected users, kept in memory; status changes go to
+# friends, DM partners and server co-members only
+presence = Presence(socketio, storage, lambda user: format_user_dict(user),
+                    debounce=float(os.environ.get('PRESENCE_DEBOUNCE', 5)),
+                    heartbeat_timeout=float(os.environ.get('PRESENCE_HEARTBEAT_TIMEOUT', 90)),
+                    # Several workers share who is online through storage
+                    shared=bool(os.environ.get('SOCKETIO_MESSAGE_QUEUE')))
+
+# Messages sent over the socket are stored and broadcast in batches
+message_batcher = MessageBatcher(socketio, storage, lambda messages: format_messages(messages),
+                                 window=float(os.environ.get('MESSAGE_BATCH_WINDOW_MS', 5)) / 1000,
+                                 on_stored=lambda messages: messages_stored(messages))
+
+# Per-user log of membership and friend changes for /api/sync
+changelog = ChangeLog(storage, retention=int(os.environ.get('SYNC_CHANGE_RETENTION', 100000)))
+SYNC_MAX_CHANGES = int(os.environ.get('SYNC_MAX_CHANGES', 500))
+SYNC_MAX_MESSAGES = int(os.environ.get('SYNC_MAX_MESSAGES', 100))
+
+# Inverted index for /api/search/messages, built on the first search
+message_index = MessageIndex(storage)
+# Username index for /api/users/search; repeated type-ahead queries hit its cache
+user_index = UserIndex(storage, cache_ttl=float(os.environ.get('USER_SEARCH_CACHE_TTL', 10)))
+
+# bcrypt runs on native threads so logins don't block the eventlet hub
+password_pool = PasswordPool(workers=int(os.environ.get('PASSWORD_WORKERS', 4)),
+                             max_pending=int(os.environ.get('PASSWORD_QUEUE_LIMIT', 64)),
+                             green=socketio.async_mode == 'eventlet')
+
+def password_pool_busy():
+    """503 response for a login or registration refused by a full password pool"""
+    auth_log.warning("Password pool is full, request refused")
+    return jsonify({'error': 'Сервер перегружен, попробуйте еще раз'}), 503, {'Retry-After': '1'}
+
+# Verified access tokens, so authorizing a known token is a dictionary lookup
+token_cache = TokenCache(lambda token: decode_access_token(token), lambda user_id: storage.get_by_id('users', user_id),
+                         max_size=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+                         ttl=float(os.environ.get('TOKEN_CACHE_TTL', 60)))
+
+def decode_access_token(token):
+    """Claims of a valid access token; raises the flask_jwt_extended errors otherwise"""
+    claims = decode_token(token)
+    if claims.get('type') != 'access':
+        raise WrongTokenError('Only non-refresh tokens are allowed')
+    return claims
+
+def auth_required(view):
+    """@jwt_required() for the Authorization header, checked through token_cache.
+    
+    Failures raise the flask_jwt_extended errors, so JWTManager answers
+    them exactly like before.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization')
+        if not header:
+            raise NoAuthorizationError('Missing Authorization Header')
+        parts = header.split()
+        if len(parts) != 2 or parts[0] != 'Bearer':
+            raise InvalidHeaderError("Bad Authorization header. Expected 'Authorization: Bearer <JWT>'")
+        g.token_entry = token_cache.verify(parts[1])
+        return view(*args, **kwargs)
+    return wrapper
+
+def current_user_id():
+    """Id of the user authorized by @auth_required"""
+    return g.token_entry.user_id
+
+def current_user():
+    """Cached fields of the authorized user (see token_cache.USER_FIELDS), or None if they are gone"""
+    return token_cache.user(g.token_entry)
+
+def update_user(user_id, updates):
+    """Update a user row and drop its cached copy"""
+    user = storage.update('users', user_id, updates)
+    token_cache.forget_user(user_id)
+    return user
 
 # Helper function to get user from token
 def get_user_from_token(token):
     """Получить пользователя из токена для WebSocket"""
     try:
-        decoded = pyjwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
-        return decoded.get('sub')
+        return token_cache.verify(token).user_id
     except Exception as e:
-        print(f"Token decode error: {e}")
+        socket_log.info("Token decode error: %s", e)
         return None
 
 # Initialize admin user
@@ -33,7 +134,7 @@ def init_admin_user():
     """Create admin user if it doesn't exist"""
     admin = storage.get_one_by_field('users', 'username', 'admin')
     if not admin:
-        print("[STORAGE] Creating admin user...")
+        storage_log.info("Creating admin user...")
         admin = storage.add('users', {
             'username': 'admin',
             'email': 'admin@rucord.com',
@@ -51,22 +152,18 @@ def init_admin_user():
             'notifications': True,
             'sound_enabled': True
         })
-        print("[STORAGE] Admin user created successfully")
+        storage_log.info("Admin user created successfully")
     else:
-        print("[STORAGE] Admin user already exists")
+        storage_log.debug("Admin user already exists")
 
 # Initialize storage
-print("[STORAGE] Initializing JSON storage...")
 init_admin_user()
 
 # Global error handler
 @app.errorhandler(Exception)
 def handle_exception(e):
-    import traceback
     error_msg = str(e)
-    error_traceback = traceback.format_exc()
-    print(f"[ERROR] Unhandled exception: {error_msg}")
-    print(f"[ERROR] Traceback:\n{error_traceback}")
+    http_log.exception("Unhandled exception: %s", error_msg)
     
     if request.path.startswith('/api/'):
         return jsonify({'error': f'Server error: {error_msg}'}), 500
@@ -87,6 +184,17 @@ def home():
 def app_route():
     return render_template('index.html')
 
+# Serializes the uniqueness check and insert of registrations
+registration_lock = Lock()
+
+def registration_conflict(username, email):
+    """Error message if the username or email is taken, else None"""
+    if storage.get_one_by_field('users', 'username', username):
+        return 'Пользователь с таким именем уже существует'
+    if storage.get_one_by_field('users', 'email', email):
+        return 'Пользователь с таким email уже существует'
+    return None
+
 @app.route('/api/register', methods=['POST'])
 def register():
     try:
@@ -101,20 +209,28 @@ def register():
         if not username or not email or not password:
             return jsonify({'error': 'Все поля обязательны'}), 400
         
-        if storage.get_one_by_field('users', 'username', username):
-            return jsonify({'error': 'Пользователь с таким именем уже существует'}), 400
+        if not all(isinstance(field, str) for field in (username, email, password)):
+            return jsonify({'error': 'Неверный формат данных'}), 400
         
-        if storage.get_one_by_field('users', 'email', email):
-            return jsonify({'error': 'Пользователь с таким email уже существует'}), 400
+        taken = registration_conflict(username, email)
+        if taken:
+            return jsonify({'error': taken}), 400
         
-        user = storage.add('users', {
-            'username': username,
-            'email': email,
-            'password_hash': hash_password(password),
-            'avatar': 'default_avatar.png',
-            'status': 'offline',
-            'status_message': None
-        })
+        password_hash = password_pool.hash(password)
+        # Hashing yields to other requests; check again and add with no yield in between
+        with registration_lock:
+            taken = registration_conflict(username, email)
+            if taken:
+                return jsonify({'error': taken}), 400
+            user = storage.add('users', {
+                'username': username,
+                'email': email,
+                'password_hash': password_hash,
+                'avatar': 'default_avatar.png',
+                'status': 'online',
+                'status_message': None
+            })
+        user_index.add([user])
         
         # Create default settings
         storage.add('user_settings', {
@@ -137,47 +253,46 @@ def register():
                 'created_at': user.get('created_at')
             }
         }), 201
+    except PasswordPoolBusy:
+        return password_pool_busy()
     except Exception as e:
-        import traceback
         error_msg = str(e)
-        traceback.print_exc()
-        print(f"[ERROR] Register error: {error_msg}")
+        auth_log.exception("Register error: %s", error_msg)
         return jsonify({'error': f'Server error: {error_msg}'}), 500
 
 @app.route('/api/login', methods=['POST'])
 def login():
     try:
-        print("[LOGIN] Login request received")
         data = request.get_json()
-        print(f"[LOGIN] Request data: {data}")
         
         if not data:
-            print("[LOGIN] No JSON data")
             return jsonify({'error': 'Invalid JSON'}), 400
             
         username = data.get('username')
         password = data.get('password')
         
         if not username or not password:
-            print("[LOGIN] Missing username or password")
             return jsonify({'error': 'Имя пользователя и пароль обязательны'}), 400
         
-        print(f"[LOGIN] Querying user: {username}")
         user = storage.get_one_by_field('users', 'username', username)
-        print(f"[LOGIN] User found: {user is not None}")
         
         if not user:
-            print(f"[LOGIN] User not found: {username}")
+            auth_log.info("Login failed: unknown user", extra={'username': username})
             return jsonify({'error': 'Неверное имя пользователя или пароль'}), 401
         
-        print("[LOGIN] Checking password")
-        if not check_password(password, user['password_hash']):
-            print("[LOGIN] Invalid password")
+        if not password_pool.check(password, user['password_hash']):
+            auth_log.info("Login failed: wrong password", extra={'user_id': user['id']})
             return jsonify({'error': 'Неверное имя пользователя или пароль'}), 401
         
-        print("[LOGIN] Creating access token")
+        # Move the hash to the current BCRYPT_ROUNDS; it can wait for a quieter login
+        if needs_rehash(user['password_hash']):
+            try:
+                update_user(user['id'], {'password_hash': password_pool.hash(password)})
+            except PasswordPoolBusy:
+                pass
+        
         access_token = create_access_token(identity=user['id'])
-        print("[LOGIN] Login successful")
+        auth_log.info("Login successful", extra={'user_id': user['id']})
         return jsonify({
             'token': access_token,
             'user': {
@@ -189,19 +304,17 @@ def login():
                 'created_at': user.get('created_at')
             }
         }), 200
+    except PasswordPoolBusy:
+        return password_pool_busy()
     except Exception as e:
-        import traceback
         error_msg = str(e)
-        error_traceback = traceback.format_exc()
-        print(f"[ERROR] Login error: {error_msg}")
-        print(f"[ERROR] Traceback:\n{error_traceback}")
+        auth_log.exception("Login error: %s", error_msg)
         return jsonify({'error': f'Server error: {error_msg}'}), 500
 
 @app.route('/api/me', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_current_user():
-    user_id = get_jwt_identity()
-    user = storage.get_by_id('users', user_id)
+    user = current_user()
     
     if not user:
         return jsonify({'error': 'Пользователь не найден'}), 404
@@ -222,7 +335,7 @@ def format_user_dict(user, include_email=False):
         'id': user['id'],
         'username': user['username'],
         'avatar': user.get('avatar', 'default_avatar.png'),
-        'status': user.get('status', 'offline'),
+        'status': presence.visible_status(user),
         'status_message': user.get('status_message'),
         'created_at': user.get('created_at')
     }
@@ -230,36 +343,215 @@ def format_user_dict(user, include_email=False):
         data['email'] = user.get('email')
     return data
 
+# Helper functions to attach users to response rows
+def get_user_dicts(user_ids):
+    """Formatted users by id, fetched with one storage lookup"""
+    users = storage.get_many('users', user_ids)
+    return {user_id: format_user_dict(user) for user_id, user in users.items()}
+
+def format_messages(messages):
+    """Format messages for response, resolving all authors in one pass"""
+    users = get_user_dicts(msg['user_id'] for msg in messages)
+    return [{
+        'id': msg['id'],
+        'channel_id': msg.get('channel_id'),
+        'dm_channel_id': msg.get('dm_channel_id'),
+        'user_id': msg['user_id'],
+        'content': msg['content'],
+        'created_at': msg.get('created_at'),
+        'edited_at': msg.get('edited_at'),
+        'user': users.get(msg['user_id'])
+    } for msg in messages]
+
+# Helper functions to check server membership
+MEMBERSHIP_CACHE_TTL = float(os.environ.get('MEMBERSHIP_CACHE_TTL', 60))
+# (user_id, server_id) -> (expires_at, membership row with role)
+membership_cache = {}
+
+def get_membership(user_id, server_id):
+    """Membership row of user in server (with its role), or None.
+    
+    Rows are cached for MEMBERSHIP_CACHE_TTL seconds and dropped by
+    invalidate_membership() on join, role change or leave. Non-members are
+    not cached, so a join handled by another worker is seen at once.
+    """
+    key = (user_id, server_id)
+    cached = membership_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return dict(cached[1])
+    member = storage.get_one_by_fields('server_members', {'user_id': user_id, 'server_id': server_id})
+    if member:
+        membership_cache[key] = (time.monotonic() + MEMBERSHIP_CACHE_TTL, dict(member))
+    else:
+        membership_cache.pop(key, None)
+    return member
+
+def invalidate_membership(user_id, server_id):
+    membership_cache.pop((user_id, server_id), None)
+
+# Helper functions for friendships and DM channels (stored as an ordered user pair)
+def get_friendship(user_id, other_user_id):
+    return storage.get_one_by_fields('friendships', {
+        'user1_id': min(user_id, other_user_id),
+        'user2_id': max(user_id, other_user_id)
+    })
+
+def get_user_pair_rows(collection, user_id):
+    """Rows of a user-pair collection (friendships, dm_channels) that include user"""
+    return storage.get_by_field(collection, 'user1_id', user_id) + storage.get_by_field(collection, 'user2_id', user_id)
+
+# DM summaries: a dm_channels row also keeps its last message, message_count
+# and a read cursor per side (user1_read_id/_count, user2_read_id/_count),
+# updated on every DM message, so the DM list needs no message reads
+DM_PREVIEW_LENGTH = 100
+
+def dm_side(dm_channel, user_id):
+    return 'user1' if dm_channel['user1_id'] == user_id else 'user2'
+
+def summarize_dm_messages(messages):
+    """Fold newly stored messages into the summaries of their DM channels"""
+    by_channel = {}
+    for msg in messages:
+        if msg.get('dm_channel_id'):
+            by_channel.setdefault(msg['dm_channel_id'], []).append(msg)
+    
+    for channel_id, channel_messages in by_channel.items():
+        def apply(dm_channel, channel_messages=channel_messages):
+            count = dm_channel.get('message_count', 0)
+            updates = {}
+            for msg in channel_messages:
+                count += 1
+                # The sender has read the channel up to their own message
+                side = dm_side(dm_channel, msg['user_id'])
+                if msg['id'] > updates.get(f'{side}_read_id', dm_channel.get(f'{side}_read_id', 0)):
+                    updates[f'{side}_read_id'] = msg['id']
+                    updates[f'{side}_read_count'] = count
+            updates['message_count'] = count
+            last = max(channel_messages, key=lambda msg: msg['id'])
+            if last['id'] > dm_channel.get('last_message_id', 0):
+                updates.update({
+                    'last_message_id': last['id'],
+                    'last_message_preview': last['content'][:DM_PREVIEW_LENGTH],
+                    'last_message_at': last.get('created_at')
+                })
+            return updates
+        storage.update('dm_channels', channel_id, apply)
+
+def backfill_dm_summaries():
+    """Build summaries for DM channels created before they existed (all marked read)"""
+    for dm_channel in storage.get_all('dm_channels'):
+        if 'message_count' in dm_channel:
+            continue
+        messages = storage.get_by_field('messages', 'dm_channel_id', dm_channel['id'])
+        last = max(messages, key=lambda msg: msg['id']) if messages else None
+        storage.update('dm_channels', dm_channel['id'], {
+            'message_count': len(messages),
+            'last_message_id': last['id'] if last else 0,
+            'last_message_preview': last['content'][:DM_PREVIEW_LENGTH] if last else None,
+            'last_message_at': last.get('created_at') if last else None,
+            'user1_read_id': last['id'] if last else 0,
+            'user1_read_count': len(messages),
+            'user2_read_id': last['id'] if last else 0,
+            'user2_read_count': len(messages)
+        })
+
+backfill_dm_summaries()
+
+def messages_stored(messages):
+    """Bookkeeping after messages are stored: DM summaries and the search index"""
+    summarize_dm_messages(messages)
+    message_index.add(messages)
+
+def get_readable_scopes(user_id):
+    """(field, id) of every channel and DM channel the user can read"""
+    scopes = [('dm_channel_id', ch['id']) for ch in get_user_pair_rows('dm_channels', user_id)]
+    for membership in storage.get_by_field('server_members', 'user_id', user_id):
+        scopes += [('channel_id', ch['id']) for ch in storage.get_by_field('channels', 'server_id', membership['server_id'])]
+    return scopes
+
+def format_dm_channel(dm_channel, user_id, other_user=None):
+    """DM channel as seen by user_id, with its last message and unread count"""
+    side = dm_side(dm_channel, user_id)
+    dm_dict = {
+        'id': dm_channel['id'],
+        'user1_id': dm_channel['user1_id'],
+        'user2_id': dm_channel['user2_id'],
+        'created_at': dm_channel.get('created_at'),
+        'last_message': {
+            'id': dm_channel['last_message_id'],
+            'content': dm_channel.get('last_message_preview'),
+            'created_at': dm_channel.get('last_message_at')
+        } if dm_channel.get('last_message_id') else None,
+        'unread_count': max(dm_channel.get('message_count', 0) - dm_channel.get(f'{side}_read_count', 0), 0)
+    }
+    if other_user:
+        dm_dict['other_user'] = other_user
+    return dm_dict
+
+# Server counters: servers rows keep member_count and channel_count, updated
+# on join and channel creation, so listing servers reads no members or channels
+def count_server(server_id, field, delta=1):
+    storage.update('servers', server_id, lambda server: {field: server.get(field, 0) + delta})
+
+def backfill_server_counters():
+    """Count members and channels of servers created before the counters existed"""
+    for server in storage.get_all('servers'):
+        if 'member_count' in server and 'channel_count' in server:
+            continue
+        storage.update('servers', server['id'], {
+            'member_count': len(storage.get_by_field('server_members', 'server_id', server['id'])),
+            'channel_count': len(storage.get_by_field('channels', 'server_id', server['id']))
+        })
+
+backfill_server_counters()
+
+def format_server(server):
+    return {
+        'id': server['id'],
+        'name': server['name'],
+        'icon': server.get('icon', 'default_server.png'),
+        'owner_id': server['owner_id'],
+        'created_at': server.get('created_at'),
+        'member_count': server.get('member_count', 0),
+        'channel_count': server.get('channel_count', 0)
+    }
+
+def get_friend_ids(user_id):
+    return {f['user2_id'] if f['user1_id'] == user_id else f['user1_id'] for f in get_user_pair_rows('friendships', user_id)}
+
+def get_friends_of_friends(user_id):
+    """Users who share a friend with user_id but are not friends with them yet"""
+    friend_ids = get_friend_ids(user_id)
+    related = set()
+    for friend_id in friend_ids:
+        related |= get_friend_ids(friend_id)
+    return related - friend_ids - {user_id}
+
+# Helper function to read one page of channel or DM history
+def get_message_page(field, channel_id):
+    """Messages for ?limit=&before=|after=|around=<message id>, oldest first, and has_more"""
+    limit = max(1, min(request.args.get('limit', 50, type=int), 100))
+    return storage.get_page('messages', field, channel_id, limit,
+                            before=request.args.get('before', type=int),
+                            after=request.args.get('after', type=int),
+                            around=request.args.get('around', type=int))
+
 # ==================== Servers API ====================
 
 @app.route('/api/servers', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_servers():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     memberships = storage.get_by_field('server_members', 'user_id', user_id)
     server_ids = [m['server_id'] for m in memberships]
-    servers = [storage.get_by_id('servers', sid) for sid in server_ids if storage.get_by_id('servers', sid)]
-    
-    result = []
-    for server in servers:
-        channels = storage.get_by_field('channels', 'server_id', server['id'])
-        members = storage.get_by_field('server_members', 'server_id', server['id'])
-        result.append({
-            'id': server['id'],
-            'name': server['name'],
-            'icon': server.get('icon', 'default_server.png'),
-            'owner_id': server['owner_id'],
-            'created_at': server.get('created_at'),
-            'member_count': len(members),
-            'channel_count': len(channels)
-        })
+    servers = storage.get_many('servers', server_ids)
     
-    return jsonify(result), 200
+    return jsonify([format_server(servers[sid]) for sid in server_ids if sid in servers]), 200
 
 @app.route('/api/servers', methods=['POST'])
-@jwt_required()
+@auth_required
 def create_server():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     name = data.get('name')
     
@@ -269,7 +561,9 @@ def create_server():
     server = storage.add('servers', {
         'name': name,
         'icon': 'default_server.png',
-        'owner_id': user_id
+        'owner_id': user_id,
+        'member_count': 1,
+        'channel_count': 1
     })
     
     # Add creator as owner
@@ -278,6 +572,7 @@ def create_server():
         'server_id': server['id'],
         'role': 'owner'
     })
+    invalidate_membership(user_id, server['id'])
     
     # Create general channel
     storage.add('channels', {
@@ -285,62 +580,35 @@ def create_server():
         'name': 'общий',
         'type': 'text'
     })
+    changelog.record([user_id], 'server_joined', {'server_id': server['id']})
     
-    return jsonify({
-        'id': server['id'],
-        'name': server['name'],
-        'icon': server.get('icon', 'default_server.png'),
-        'owner_id': server['owner_id'],
-        'created_at': server.get('created_at'),
-        'member_count': 1,
-        'channel_count': 1
-    }), 201
+    return jsonify(format_server(server)), 201
 
 @app.route('/api/servers/<int:server_id>', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_server(server_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
-    members = storage.get_by_field('server_members', 'user_id', user_id)
-    member = None
-    for m in members:
-        if m.get('server_id') == server_id:
-            member = m
-            break
-    
-    if not member:
+    if not get_membership(user_id, server_id):
         return jsonify({'error': 'У вас нет доступа к этому серверу'}), 403
     
     server = storage.get_by_id('servers', server_id)
     if not server:
         return jsonify({'error': 'Сервер не найден'}), 404
     
-    channels = storage.get_by_field('channels', 'server_id', server_id)
-    members = storage.get_by_field('server_members', 'server_id', server_id)
-    
-    return jsonify({
-        'id': server['id'],
-        'name': server['name'],
-        'icon': server.get('icon', 'default_server.png'),
-        'owner_id': server['owner_id'],
-        'created_at': server.get('created_at'),
-        'member_count': len(members),
-        'channel_count': len(channels)
-    }), 200
+    return jsonify(format_server(server)), 200
 
 @app.route('/api/servers/<int:server_id>/join', methods=['POST'])
-@jwt_required()
+@auth_required
 def join_server(server_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
     server = storage.get_by_id('servers', server_id)
     if not server:
         return jsonify({'error': 'Сервер не найден'}), 404
     
     # Check if already a member
-    existing = storage.get_by_field('server_members', 'user_id', user_id)
-    existing = [m for m in existing if m.get('server_id') == server_id]
-    if existing:
+    if get_membership(user_id, server_id):
         return jsonify({'error': 'Вы уже участник этого сервера'}), 400
     
     storage.add('server_members', {
@@ -348,6 +616,12 @@ def join_server(server_id):
         'server_id': server_id,
         'role': 'member'
     })
+    count_server(server_id, 'member_count')
+    invalidate_membership(user_id, server_id)
+    member_ids = [m['user_id'] for m in storage.get_by_field('server_members', 'server_id', server_id)]
+    presence.invalidate(*member_ids)
+    changelog.record([user_id], 'server_joined', {'server_id': server_id})
+    changelog.record_server(server_id, 'member_joined', {'server_id': server_id, 'user_id': user_id})
     
     return jsonify({'message': 'Вы присоединились к серверу', 'server': {
         'id': server['id'],
@@ -358,12 +632,11 @@ def join_server(server_id):
     }}), 200
 
 @app.route('/api/servers/<int:server_id>/channels', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_channels(server_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
-    member = storage.get_one_by_field('server_members', 'user_id', user_id)
-    if not member or member.get('server_id') != server_id:
+    if not get_membership(user_id, server_id):
         return jsonify({'error': 'У вас нет доступа к этому серверу'}), 403
     
     channels = storage.get_by_field('channels', 'server_id', server_id)
@@ -379,9 +652,9 @@ def get_channels(server_id):
     } for ch in channels]), 200
 
 @app.route('/api/servers/<int:server_id>/channels', methods=['POST'])
-@jwt_required()
+@auth_required
 def create_channel(server_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     name = data.get('name')
     channel_type = data.get('type', 'text')
@@ -389,13 +662,7 @@ def create_channel(server_id):
     if not name:
         return jsonify({'error': 'Имя канала обязательно'}), 400
     
-    members = storage.get_by_field('server_members', 'user_id', user_id)
-    member = None
-    for m in members:
-        if m.get('server_id') == server_id:
-            member = m
-            break
-    
+    member = get_membership(user_id, server_id)
     if not member:
         return jsonify({'error': 'У вас нет доступа к этому серверу'}), 403
     
@@ -407,6 +674,8 @@ def create_channel(server_id):
         'name': name,
         'type': channel_type
     })
+    count_server(server_id, 'channel_count')
+    changelog.record_server(server_id, 'channel_created', {'server_id': server_id, 'channel_id': channel['id']})
     
     return jsonify({
         'id': channel['id'],
@@ -418,50 +687,25 @@ def create_channel(server_id):
     }), 201
 
 @app.route('/api/channels/<int:channel_id>/messages', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_messages(channel_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
     channel = storage.get_by_id('channels', channel_id)
     if not channel:
         return jsonify({'error': 'Канал не найден'}), 404
     
-    members = storage.get_by_field('server_members', 'user_id', user_id)
-    member = None
-    for m in members:
-        if m.get('server_id') == channel['server_id']:
-            member = m
-            break
-    
-    if not member:
+    if not get_membership(user_id, channel['server_id']):
         return jsonify({'error': 'У вас нет доступа к этому каналу'}), 403
     
-    limit = request.args.get('limit', 50, type=int)
-    messages = storage.get_by_field('messages', 'channel_id', channel_id)
-    messages.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    messages = messages[:limit]
-    messages.reverse()
-    
-    result = []
-    for msg in messages:
-        user = storage.get_by_id('users', msg['user_id'])
-        result.append({
-            'id': msg['id'],
-            'channel_id': msg.get('channel_id'),
-            'dm_channel_id': msg.get('dm_channel_id'),
-            'user_id': msg['user_id'],
-            'content': msg['content'],
-            'created_at': msg.get('created_at'),
-            'edited_at': msg.get('edited_at'),
-            'user': format_user_dict(user) if user else None
-        })
+    messages, has_more = get_message_page('channel_id', channel_id)
     
-    return jsonify(result), 200
+    return jsonify({'messages': format_messages(messages), 'has_more': has_more}), 200
 
 @app.route('/api/channels/<int:channel_id>/messages', methods=['POST'])
-@jwt_required()
+@auth_required
 def create_message(channel_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     content = data.get('content')
     
@@ -472,61 +716,72 @@ def create_message(channel_id):
     if not channel:
         return jsonify({'error': 'Канал не найден'}), 404
     
-    members = storage.get_by_field('server_members', 'user_id', user_id)
-    member = None
-    for m in members:
-        if m.get('server_id') == channel['server_id']:
-            member = m
-            break
-    
-    if not member:
+    if not get_membership(user_id, channel['server_id']):
         return jsonify({'error': 'У вас нет доступа к этому каналу'}), 403
     
+    # A retry of a send that already went through returns the stored message
+    nonce = data.get('nonce')
+    if not valid_nonce(nonce):
+        return jsonify({'error': 'Неверный nonce'}), 400
+    known = message_batcher.recall(user_id, nonce)
+    if known:
+        return jsonify(known), 200
+    
     message = storage.add('messages', {
         'channel_id': channel_id,
         'user_id': user_id,
         'content': content.strip()
     })
     
-    user = storage.get_by_id('users', user_id)
-    message_dict = {
-        'id': message['id'],
-        'channel_id': message.get('channel_id'),
-        'dm_channel_id': message.get('dm_channel_id'),
-        'user_id': message['user_id'],
-        'content': message['content'],
-        'created_at': message.get('created_at'),
-        'edited_at': message.get('edited_at'),
-        'user': format_user_dict(user) if user else None
-    }
+    message_index.add([message])
+    message_dict = format_messages([message])[0]
+    message_batcher.remember(user_id, nonce, message_dict)
     
     socketio.emit('new_message', message_dict, room=f'channel_{channel_id}')
     
     return jsonify(message_dict), 201
 
+@app.route('/api/search/messages', methods=['GET'])
+@auth_required
+def search_messages():
+    """Поиск сообщений в каналах и ЛС пользователя: ?q=&limit=&offset="""
+    user_id = current_user_id()
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    if len(query) < 2:
+        return jsonify({'error': 'Слишком короткий запрос'}), 400
+    
+    message_ids, total = message_index.search(query, set(get_readable_scopes(user_id)), limit, offset)
+    messages = format_messages(message_index.fetch(message_ids))
+    
+    return jsonify({'messages': messages, 'total': total, 'has_more': offset + len(message_ids) < total}), 200
+
 # ==================== Friends API ====================
 
 @app.route('/api/users/search', methods=['GET'])
-@jwt_required()
+@auth_required
 def search_users():
-    user_id = get_jwt_identity()
-    query = request.args.get('q', '').lower()
+    user_id = current_user_id()
+    query = request.args.get('q', '').strip()
     
-    if not query or len(query) < 2:
+    if len(query) < 2:
         return jsonify([]), 200
     
-    all_users = storage.get_all('users')
-    matching = [u for u in all_users if query in u.get('username', '').lower() and u['id'] != user_id]
+    user_ids = user_index.search(query, user_id, 10, related=lambda: get_friends_of_friends(user_id))
+    users = get_user_dicts(user_ids)
     
-    return jsonify([format_user_dict(u) for u in matching[:10]]), 200
+    return jsonify([users[uid] for uid in user_ids if uid in users]), 200
 
 @app.route('/api/friends/requests', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_friend_requests():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
     incoming = [r for r in storage.get_by_field('friend_requests', 'to_user_id', user_id) if r.get('status') == 'pending']
     outgoing = [r for r in storage.get_by_field('friend_requests', 'from_user_id', user_id) if r.get('status') == 'pending']
+    users = get_user_dicts([r['from_user_id'] for r in incoming + outgoing] + [r['to_user_id'] for r in incoming + outgoing])
     
     def enrich_request(req):
         req_dict = {
@@ -536,12 +791,10 @@ def get_friend_requests():
             'status': req.get('status', 'pending'),
             'created_at': req.get('created_at')
         }
-        from_user = storage.get_by_id('users', req['from_user_id'])
-        to_user = storage.get_by_id('users', req['to_user_id'])
-        if from_user:
-            req_dict['from_user'] = format_user_dict(from_user)
-        if to_user:
-            req_dict['to_user'] = format_user_dict(to_user)
+        if req['from_user_id'] in users:
+            req_dict['from_user'] = users[req['from_user_id']]
+        if req['to_user_id'] in users:
+            req_dict['to_user'] = users[req['to_user_id']]
         return req_dict
     
     return jsonify({
@@ -550,9 +803,9 @@ def get_friend_requests():
     }), 200
 
 @app.route('/api/friends/requests', methods=['POST'])
-@jwt_required()
+@auth_required
 def send_friend_request():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     to_user_id = data.get('to_user_id')
     
@@ -567,26 +820,14 @@ def send_friend_request():
         return jsonify({'error': 'Пользователь не найден'}), 404
     
     # Check if already friends
-    friendships = storage.get_all('friendships')
-    friendship = None
-    for f in friendships:
-        if (f['user1_id'] == user_id and f['user2_id'] == to_user_id) or \
-           (f['user1_id'] == to_user_id and f['user2_id'] == user_id):
-            friendship = f
-            break
-    
-    if friendship:
+    if get_friendship(user_id, to_user_id):
         return jsonify({'error': 'Вы уже друзья'}), 400
     
     # Check if request already exists
-    all_requests = storage.get_all('friend_requests')
-    existing_request = None
-    for req in all_requests:
-        if ((req['from_user_id'] == user_id and req['to_user_id'] == to_user_id) or \
-            (req['from_user_id'] == to_user_id and req['to_user_id'] == user_id)) and \
-           req.get('status') == 'pending':
-            existing_request = req
-            break
+    existing_request = (
+        storage.get_one_by_fields('friend_requests', {'from_user_id': user_id, 'to_user_id': to_user_id, 'status': 'pending'}) or
+        storage.get_one_by_fields('friend_requests', {'from_user_id': to_user_id, 'to_user_id': user_id, 'status': 'pending'})
+    )
     
     if existing_request:
         if existing_request['from_user_id'] == user_id:
@@ -598,6 +839,8 @@ def send_friend_request():
                 'user1_id': min(user_id, to_user_id),
                 'user2_id': max(user_id, to_user_id)
             })
+            presence.invalidate(user_id, to_user_id)
+            changelog.record([user_id, to_user_id], 'friend_added', {'request_id': existing_request['id']})
             return jsonify({'message': 'Запрос принят'}), 200
     
     friend_request = storage.add('friend_requests', {
@@ -612,19 +855,21 @@ def send_friend_request():
         'to_user_id': friend_request['to_user_id'],
         'status': friend_request.get('status', 'pending'),
         'created_at': friend_request.get('created_at'),
-        'from_user': format_user_dict(storage.get_by_id('users', user_id)),
+        'from_user': format_user_dict(current_user()),
         'to_user': format_user_dict(to_user)
     }
     
+    changelog.record([to_user_id, user_id], 'friend_request', {'request_id': friend_request['id']})
+    
     user_room = f'user_{to_user_id}'
     socketio.emit('friend_request_received', request_dict, room=user_room)
     
     return jsonify(request_dict), 201
 
 @app.route('/api/friends/requests/<int:request_id>/accept', methods=['POST'])
-@jwt_required()
+@auth_required
 def accept_friend_request(request_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
     friend_request = storage.get_by_id('friend_requests', request_id)
     if not friend_request:
@@ -642,6 +887,8 @@ def accept_friend_request(request_id):
         'user1_id': min(friend_request['from_user_id'], friend_request['to_user_id']),
         'user2_id': max(friend_request['from_user_id'], friend_request['to_user_id'])
     })
+    presence.invalidate(friendship['user1_id'], friendship['user2_id'])
+    changelog.record([friendship['user1_id'], friendship['user2_id']], 'friend_added', {'request_id': request_id})
     
     user1 = storage.get_by_id('users', friendship['user1_id'])
     user2 = storage.get_by_id('users', friendship['user2_id'])
@@ -663,9 +910,9 @@ def accept_friend_request(request_id):
     return jsonify({'message': 'Запрос принят', 'friendship': friendship_dict}), 200
 
 @app.route('/api/friends/requests/<int:request_id>/decline', methods=['POST'])
-@jwt_required()
+@auth_required
 def decline_friend_request(request_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
     friend_request = storage.get_by_id('friend_requests', request_id)
     if not friend_request:
@@ -675,89 +922,60 @@ def decline_friend_request(request_id):
         return jsonify({'error': 'У вас нет прав для отклонения этого запроса'}), 403
     
     storage.update('friend_requests', request_id, {'status': 'declined'})
+    changelog.record([friend_request['from_user_id'], user_id], 'friend_request_declined', {'request_id': request_id})
     
     return jsonify({'message': 'Запрос отклонен'}), 200
 
 @app.route('/api/friends', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_friends():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
-    friendships = storage.get_all('friendships')
-    user_friendships = [f for f in friendships if f['user1_id'] == user_id or f['user2_id'] == user_id]
+    user_friendships = get_user_pair_rows('friendships', user_id)
+    friend_ids = [f['user2_id'] if f['user1_id'] == user_id else f['user1_id'] for f in user_friendships]
+    users = get_user_dicts(friend_ids)
     
-    friends = []
-    for friendship in user_friendships:
-        friend_id = friendship['user2_id'] if friendship['user1_id'] == user_id else friendship['user1_id']
-        friend = storage.get_by_id('users', friend_id)
-        if friend:
-            friends.append(format_user_dict(friend))
+    friends = [users[friend_id] for friend_id in friend_ids if friend_id in users]
     
     return jsonify(friends), 200
 
 @app.route('/api/friends/<int:friend_id>', methods=['DELETE'])
-@jwt_required()
+@auth_required
 def remove_friend(friend_id):
-    user_id = get_jwt_identity()
-    
-    friendships = storage.get_all('friendships')
-    friendship = None
-    for f in friendships:
-        if ((f.get('user1_id') == user_id and f.get('user2_id') == friend_id) or
-            (f.get('user1_id') == friend_id and f.get('user2_id') == user_id)):
-            friendship = f
-            break
+    user_id = current_user_id()
     
+    friendship = get_friendship(user_id, friend_id)
     if not friendship:
         return jsonify({'error': 'Дружба не найдена'}), 404
     
     storage.delete('friendships', friendship['id'])
+    presence.invalidate(user_id, friend_id)
+    changelog.record([user_id, friend_id], 'friend_removed', {'friendship_id': friendship['id']})
     
     return jsonify({'message': 'Друг удален'}), 200
 
 # ==================== DM Channels API ====================
 
 @app.route('/api/dm-channels', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_dm_channels():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
-    all_channels = storage.get_all('dm_channels')
-    user_channels = [ch for ch in all_channels if ch['user1_id'] == user_id or ch['user2_id'] == user_id]
+    user_channels = get_user_pair_rows('dm_channels', user_id)
     user_channels.sort(key=lambda x: x.get('created_at', ''), reverse=True)
+    users = get_user_dicts(ch['user2_id'] if ch['user1_id'] == user_id else ch['user1_id'] for ch in user_channels)
     
     result = []
     for channel in user_channels:
         other_user_id = channel['user2_id'] if channel['user1_id'] == user_id else channel['user1_id']
-        other_user = storage.get_by_id('users', other_user_id)
-        
-        messages = storage.get_by_field('messages', 'dm_channel_id', channel['id'])
-        last_message = messages[-1] if messages else None
-        
-        dm_dict = {
-            'id': channel['id'],
-            'user1_id': channel['user1_id'],
-            'user2_id': channel['user2_id'],
-            'created_at': channel.get('created_at'),
-            'last_message': {
-                'id': last_message['id'],
-                'content': last_message['content'],
-                'created_at': last_message.get('created_at')
-            } if last_message else None,
-            'unread_count': 0
-        }
-        
-        if other_user:
-            dm_dict['other_user'] = format_user_dict(other_user)
-        
-        result.append(dm_dict)
+        result.append(format_dm_channel(channel, user_id, users.get(other_user_id)))
     
     return jsonify(result), 200
 
 @app.route('/api/dm-channels', methods=['POST'])
-@jwt_required()
+@auth_required
 def create_dm_channel():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     other_user_id = data.get('user_id')
     
@@ -772,50 +990,29 @@ def create_dm_channel():
         return jsonify({'error': 'Пользователь не найден'}), 404
     
     # Check if channel already exists
-    all_channels = storage.get_all('dm_channels')
-    existing_channel = None
-    for ch in all_channels:
-        if ((ch.get('user1_id') == user_id and ch.get('user2_id') == other_user_id) or
-            (ch.get('user1_id') == other_user_id and ch.get('user2_id') == user_id)):
-            existing_channel = ch
-            break
+    existing_channel = storage.get_one_by_fields('dm_channels', {
+        'user1_id': min(user_id, other_user_id),
+        'user2_id': max(user_id, other_user_id)
+    })
     
     if existing_channel:
-        dm_dict = {
-            'id': existing_channel['id'],
-            'user1_id': existing_channel['user1_id'],
-            'user2_id': existing_channel['user2_id'],
-            'created_at': existing_channel.get('created_at'),
-            'last_message': None,
-            'unread_count': 0
-        }
-        if other_user:
-            dm_dict['other_user'] = format_user_dict(other_user)
-        return jsonify(dm_dict), 200
+        return jsonify(format_dm_channel(existing_channel, user_id, format_user_dict(other_user))), 200
     
     # Create new channel
     dm_channel = storage.add('dm_channels', {
         'user1_id': min(user_id, other_user_id),
-        'user2_id': max(user_id, other_user_id)
+        'user2_id': max(user_id, other_user_id),
+        'message_count': 0
     })
+    presence.invalidate(user_id, other_user_id)
+    changelog.record([user_id, other_user_id], 'dm_channel_created', {'dm_channel_id': dm_channel['id']})
     
-    dm_dict = {
-        'id': dm_channel['id'],
-        'user1_id': dm_channel['user1_id'],
-        'user2_id': dm_channel['user2_id'],
-        'created_at': dm_channel.get('created_at'),
-        'last_message': None,
-        'unread_count': 0
-    }
-    if other_user:
-        dm_dict['other_user'] = format_user_dict(other_user)
-    
-    return jsonify(dm_dict), 201
+    return jsonify(format_dm_channel(dm_channel, user_id, format_user_dict(other_user))), 201
 
 @app.route('/api/dm-channels/<int:channel_id>/messages', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_dm_messages(channel_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
     dm_channel = storage.get_by_id('dm_channels', channel_id)
     if not dm_channel:
@@ -824,32 +1021,14 @@ def get_dm_messages(channel_id):
     if dm_channel.get('user1_id') != user_id and dm_channel.get('user2_id') != user_id:
         return jsonify({'error': 'У вас нет доступа к этому каналу'}), 403
     
-    limit = request.args.get('limit', 50, type=int)
-    messages = storage.get_by_field('messages', 'dm_channel_id', channel_id)
-    messages.sort(key=lambda x: x.get('created_at', ''), reverse=True)
-    messages = messages[:limit]
-    messages.reverse()
-    
-    result = []
-    for msg in messages:
-        user = storage.get_by_id('users', msg['user_id'])
-        result.append({
-            'id': msg['id'],
-            'channel_id': msg.get('channel_id'),
-            'dm_channel_id': msg.get('dm_channel_id'),
-            'user_id': msg['user_id'],
-            'content': msg['content'],
-            'created_at': msg.get('created_at'),
-            'edited_at': msg.get('edited_at'),
-            'user': format_user_dict(user) if user else None
-        })
+    messages, has_more = get_message_page('dm_channel_id', channel_id)
     
-    return jsonify(result), 200
+    return jsonify({'messages': format_messages(messages), 'has_more': has_more}), 200
 
 @app.route('/api/dm-channels/<int:channel_id>/messages', methods=['POST'])
-@jwt_required()
+@auth_required
 def create_dm_message(channel_id):
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     content = data.get('content')
     
@@ -863,23 +1042,22 @@ def create_dm_message(channel_id):
     if dm_channel.get('user1_id') != user_id and dm_channel.get('user2_id') != user_id:
         return jsonify({'error': 'У вас нет доступа к этому каналу'}), 403
     
+    nonce = data.get('nonce')
+    if not valid_nonce(nonce):
+        return jsonify({'error': 'Неверный nonce'}), 400
+    known = message_batcher.recall(user_id, nonce)
+    if known:
+        return jsonify(known), 200
+    
     message = storage.add('messages', {
         'dm_channel_id': channel_id,
         'user_id': user_id,
         'content': content.strip()
     })
     
-    user = storage.get_by_id('users', user_id)
-    message_dict = {
-        'id': message['id'],
-        'channel_id': message.get('channel_id'),
-        'dm_channel_id': message.get('dm_channel_id'),
-        'user_id': message['user_id'],
-        'content': message['content'],
-        'created_at': message.get('created_at'),
-        'edited_at': message.get('edited_at'),
-        'user': format_user_dict(user) if user else None
-    }
+    messages_stored([message])
+    message_dict = format_messages([message])[0]
+    message_batcher.remember(user_id, nonce, message_dict)
     
     socketio.emit('new_dm_message', message_dict, room=f'dm_channel_{channel_id}')
     
@@ -888,12 +1066,105 @@ def create_dm_message(channel_id):
     
     return jsonify(message_dict), 201
 
+@app.route('/api/dm-channels/<int:channel_id>/read', methods=['POST'])
+@auth_required
+def mark_dm_read(channel_id):
+    """Move the user's read cursor to ?message_id (the last message by default)"""
+    user_id = current_user_id()
+    data = request.get_json(silent=True) or {}
+    message_id = data.get('message_id')
+    
+    dm_channel = storage.get_by_id('dm_channels', channel_id)
+    if not dm_channel:
+        return jsonify({'error': 'Канал не найден'}), 404
+    
+    if dm_channel.get('user1_id') != user_id and dm_channel.get('user2_id') != user_id:
+        return jsonify({'error': 'У вас нет доступа к этому каналу'}), 403
+    
+    if message_id is not None and not isinstance(message_id, int):
+        return jsonify({'error': 'Неверный ID сообщения'}), 400
+    
+    side = dm_side(dm_channel, user_id)
+    last_id = dm_channel.get('last_message_id', 0)
+    read_id = last_id if message_id is None else min(message_id, last_id)
+    # Messages up to read_id, counted before the update: its function must not call storage
+    read_count = dm_channel.get('message_count', 0)
+    if read_id < last_id:
+        newer = storage.get_page('messages', 'dm_channel_id', channel_id, read_count, after=read_id)[0]
+        read_count -= sum(1 for message in newer if message['id'] <= last_id)
+    
+    def apply(dm_channel):
+        # The cursor may have moved past read_id meanwhile
+        if read_id <= dm_channel.get(f'{side}_read_id', 0):
+            return {}
+        return {f'{side}_read_id': read_id, f'{side}_read_count': read_count}
+    
+    updated = storage.update('dm_channels', channel_id, apply)
+    return jsonify(format_dm_channel(updated, user_id)), 200
+
+# ==================== Sync API ====================
+
+@app.route('/api/sync', methods=['GET'])
+@auth_required
+def sync():
+    """Everything that changed for the user since ?since=<token>.
+    
+    Without a usable token returns only reset=true and a fresh token; the
+    client then loads its state in full and syncs from that token.
+    """
+    user_id = current_user_id()
+    since = parse_sync_token(request.args.get('since'))
+    
+    # High-water marks first: whatever is stored after them goes to the next sync
+    last_message_id = storage.get_last_id('messages')
+    last_change_id = storage.get_last_id('changes')
+    presence_cursor = presence.cursor()
+    reset = {'reset': True, 'token': make_sync_token(last_change_id, last_message_id, presence_cursor)}
+    
+    if (since is None or not changelog.floor(last_change_id) <= since[0] <= last_change_id
+            or since[1] > last_message_id):
+        return jsonify(reset), 200
+    change_id, message_id, since_presence = since
+    
+    server_ids = [m['server_id'] for m in storage.get_by_field('server_members', 'user_id', user_id)]
+    changes, more = changelog.since(user_id, server_ids, change_id, last_change_id, SYNC_MAX_CHANGES)
+    if more:
+        return jsonify(reset), 200
+    
+    # New messages of every channel and DM the user can read now
+    messages = []
+    truncated = []
+    for field, target_id in get_readable_scopes(user_id):
+        page, more = storage.get_page('messages', field, target_id, SYNC_MAX_MESSAGES, after=message_id)
+        page = [msg for msg in page if msg['id'] <= last_message_id]
+        if more and len(page) == SYNC_MAX_MESSAGES:
+            # Too far behind in this channel, the client reloads its history
+            truncated.append({field: target_id})
+        messages += page
+    messages.sort(key=lambda msg: msg['id'])
+    
+    users = get_user_dicts(presence.changed_since(presence.audience(user_id), since_presence))
+    
+    return jsonify({
+        'reset': False,
+        'token': make_sync_token(last_change_id, last_message_id, presence_cursor),
+        'changes': [{
+            'id': change['id'],
+            'kind': change['kind'],
+            'data': change.get('data'),
+            'created_at': change.get('created_at')
+        } for change in changes],
+        'messages': format_messages(messages),
+        'truncated': truncated,
+        'users': list(users.values())
+    }), 200
+
 # ==================== Settings API ====================
 
 @app.route('/api/settings', methods=['GET'])
-@jwt_required()
+@auth_required
 def get_settings():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     
     settings = storage.get_one_by_field('user_settings', 'user_id', user_id)
     if not settings:
@@ -915,9 +1186,9 @@ def get_settings():
     }), 200
 
 @app.route('/api/settings', methods=['PUT'])
-@jwt_required()
+@auth_required
 def update_settings():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     
     settings = storage.get_one_by_field('user_settings', 'user_id', user_id)
@@ -953,13 +1224,12 @@ def update_settings():
     }), 200
 
 @app.route('/api/me/status', methods=['PUT'])
-@jwt_required()
+@auth_required
 def update_status():
-    user_id = get_jwt_identity()
+    user_id = current_user_id()
     data = request.get_json()
     
-    user = storage.get_by_id('users', user_id)
-    if not user:
+    if not current_user():
         return jsonify({'error': 'Пользователь не найден'}), 404
     
     updates = {}
@@ -968,10 +1238,10 @@ def update_status():
     if 'status_message' in data:
         updates['status_message'] = data['status_message']
     
-    storage.update('users', user_id, updates)
-    updated = storage.get_by_id('users', user_id)
+    # Only the chosen status is stored; online/offline comes from the sessions
+    updated = update_user(user_id, updates)
     
-    socketio.emit('user_status_changed', format_user_dict(updated), namespace='/')
+    presence.status_changed(user_id, format_user_dict(updated))
     
     return jsonify(format_user_dict(updated)), 200
 
@@ -988,47 +1258,40 @@ def on_connect(auth=None):
             token = flask_request.headers.get('Authorization', '').replace('Bearer ', '')
         
         if not token:
-            print('No token provided in WebSocket connection')
+            socket_log.info('No token provided in WebSocket connection')
             return False
         
         user_id = get_user_from_token(token)
         if not user_id:
-            print(f'Invalid token in WebSocket connection')
+            socket_log.info('Invalid token in WebSocket connection')
             return False
         
-        print(f'[SOCKET] Пользователь {user_id} подключился')
         session['user_id'] = user_id
+        join_room(f'user_{user_id}')
+        socket_log.info('Пользователь %s подключился', user_id, extra={'sid': request.sid})
         
-        user_room = f'user_{user_id}'
-        join_room(user_room)
-        print(f'[SOCKET] Пользователь {user_id} присоединился к комнате {user_room}')
-        
-        # Update user status to online
-        user = storage.get_by_id('users', user_id)
-        if user:
-            storage.update('users', user_id, {'status': 'online'})
-            updated = storage.get_by_id('users', user_id)
-            socketio.emit('user_status_changed', format_user_dict(updated), namespace='/')
+        # Register the session; the first one makes the user visible as online
+        presence.connect(user_id, request.sid)
         
         emit('connected', {'message': 'Подключено к RUCord'})
         return True
     except Exception as e:
-        print(f'[SOCKET] Error in on_connect: {e}')
-        import traceback
-        traceback.print_exc()
+        socket_log.exception('Error in on_connect: %s', e)
         return False
 
 @socketio.on('disconnect')
 def on_disconnect():
     user_id = session.get('user_id')
     if user_id:
-        print(f'Пользователь {user_id} отключился')
-        # Update status to offline
-        user = storage.get_by_id('users', user_id)
-        if user:
-            storage.update('users', user_id, {'status': 'offline'})
-            updated = storage.get_by_id('users', user_id)
-            socketio.emit('user_status_changed', format_user_dict(updated), namespace='/')
+        socket_log.info('Пользователь %s отключился', user_id, extra={'sid': request.sid})
+        # The last session going away makes the user offline unless they come back shortly
+        presence.disconnect(user_id, request.sid)
+
+@socketio.on('heartbeat')
+def on_heartbeat():
+    user_id = session.get('user_id')
+    if user_id:
+        presence.heartbeat(user_id, request.sid)
 
 @socketio.on('join_channel')
 def on_join_channel(data):
@@ -1044,14 +1307,7 @@ def on_join_channel(data):
     if not channel:
         return
     
-    members = storage.get_by_field('server_members', 'user_id', user_id)
-    member = None
-    for m in members:
-        if m.get('server_id') == channel['server_id']:
-            member = m
-            break
-    
-    if not member:
+    if not get_membership(user_id, channel['server_id']):
         return
     
     room = f'channel_{channel_id}'
@@ -1083,12 +1339,6 @@ def on_join_dm_channel(data):
     if dm_channel.get('user1_id') != user_id and dm_channel.get('user2_id') != user_id:
         return
     
-    user = storage.get_by_id('users', user_id)
-    if user:
-        storage.update('users', user_id, {'status': 'online'})
-        updated = storage.get_by_id('users', user_id)
-        socketio.emit('user_status_changed', format_user_dict(updated), namespace='/')
-    
     room = f'dm_channel_{channel_id}'
     user_room = f'user_{user_id}'
     join_room(room)
@@ -1103,13 +1353,58 @@ def on_leave_dm_channel(data):
         leave_room(room)
         emit('left_dm_channel', {'channel_id': channel_id})
 
+@socketio.on('send_message')
+def on_send_message(data):
+    """Отправка сообщения через WebSocket; ответ (ack) содержит сохранённое сообщение"""
+    user_id = session.get('user_id')
+    if not user_id:
+        return {'error': 'Не авторизован'}
+    if not isinstance(data, dict):
+        return {'error': 'Неверный запрос'}
+    
+    nonce = data.get('nonce')
+    if not valid_nonce(nonce):
+        return {'error': 'Неверный nonce'}
+    content = data.get('content')
+    if not isinstance(content, str) or not content.strip():
+        return {'error': 'Сообщение не может быть пустым', 'nonce': nonce}
+    
+    channel_id = data.get('channel_id')
+    dm_channel_id = data.get('dm_channel_id')
+    item = {'user_id': user_id, 'content': content.strip()}
+    if isinstance(channel_id, int):
+        channel = storage.get_by_id('channels', channel_id)
+        if not channel:
+            return {'error': 'Канал не найден', 'nonce': nonce}
+        if not get_membership(user_id, channel['server_id']):
+            return {'error': 'У вас нет доступа к этому каналу', 'nonce': nonce}
+        item['channel_id'] = channel['id']
+        event, rooms = 'new_messages', [f"channel_{channel['id']}"]
+    elif isinstance(dm_channel_id, int):
+        dm_channel = storage.get_by_id('dm_channels', dm_channel_id)
+        if not dm_channel:
+            return {'error': 'Канал не найден', 'nonce': nonce}
+        if dm_channel.get('user1_id') != user_id and dm_channel.get('user2_id') != user_id:
+            return {'error': 'У вас нет доступа к этому каналу', 'nonce': nonce}
+        other_user_id = dm_channel['user2_id'] if dm_channel['user1_id'] == user_id else dm_channel['user1_id']
+        item['dm_channel_id'] = dm_channel['id']
+        event, rooms = 'new_dm_messages', [f"dm_channel_{dm_channel['id']}", f'user_{other_user_id}']
+    else:
+        return {'error': 'Не указан канал', 'nonce': nonce}
+    
+    try:
+        message = message_batcher.send(item, event, rooms, nonce=nonce)
+    except Exception:
+        return {'error': 'Не удалось отправить сообщение', 'nonce': nonce}
+    return {'message': message, 'nonce': nonce}
+
 # ==================== Call WebSocket Events ====================
 
 @socketio.on('call_request')
 def on_call_request(data):
     user_id = session.get('user_id')
     if not user_id:
-        print(f'[CALL] No user_id in session for call_request')
+        call_log.warning('No user_id in session for call_request')
         return
     
     to_user_id = data.get('to_user_id')
@@ -1117,14 +1412,12 @@ def on_call_request(data):
     offer = data.get('offer')
     
     if not to_user_id:
-        print(f'[CALL] No to_user_id in call_request')
+        call_log.warning('No to_user_id in call_request')
         return
     
-    print(f'[CALL] User {user_id} calling user {to_user_id}, type: {call_type}')
-    print(f'[CALL] Offer present: {offer is not None}')
+    call_log.info('User %s calling user %s, type: %s, offer present: %s', user_id, to_user_id, call_type, offer is not None)
     
     user_room = f'user_{to_user_id}'
-    print(f'[CALL] Sending call_incoming to room: {user_room}')
     
     try:
         socketio.emit('call_incoming', {
@@ -1132,11 +1425,9 @@ def on_call_request(data):
             'type': call_type,
             'offer': offer
         }, room=user_room)
-        print(f'[CALL] Successfully sent call_incoming to room {user_room}')
+        call_log.debug('Sent call_incoming to room %s', user_room)
     except Exception as e:
-        print(f'[CALL] Error sending call_incoming: {e}')
-        import traceback
-        traceback.print_exc()
+        call_log.exception('Error sending call_incoming: %s', e)
 
 @socketio.on('call_accept')
 def on_call_accept(data):
@@ -1144,7 +1435,7 @@ def on_call_accept(data):
     to_user_id = data.get('to_user_id')
     
     if user_id and to_user_id:
-        print(f'[CALL] User {user_id} accepted call from user {to_user_id}')
+        call_log.info('User %s accepted call from user %s', user_id, to_user_id)
         user_room = f'user_{to_user_id}'
         socketio.emit('call_accepted', {
             'from_user_id': user_id
@@ -1156,7 +1447,7 @@ def on_call_reject(data):
     to_user_id = data.get('to_user_id')
     
     if user_id and to_user_id:
-        print(f'[CALL] User {user_id} rejected call from user {to_user_id}')
+        call_log.info('User %s rejected call from user %s', user_id, to_user_id)
         user_room = f'user_{to_user_id}'
         socketio.emit('call_rejected', {
             'from_user_id': user_id
@@ -1168,7 +1459,7 @@ def on_call_end(data):
     to_user_id = data.get('to_user_id')
     
     if user_id and to_user_id:
-        print(f'[CALL] User {user_id} ended call with user {to_user_id}')
+        call_log.info('User %s ended call with user %s', user_id, to_user_id)
         user_room = f'user_{to_user_id}'
         socketio.emit('call_ended', {
             'from_user_id': user_id
@@ -1181,7 +1472,7 @@ def on_call_offer(data):
     offer = data.get('offer')
     
     if user_id and to_user_id and offer:
-        print(f'[CALL] User {user_id} sending offer to user {to_user_id}')
+        call_log.debug('User %s sending offer to user %s', user_id, to_user_id)
         user_room = f'user_{to_user_id}'
         socketio.emit('call_offer', {
             'from_user_id': user_id,
@@ -1195,7 +1486,7 @@ def on_call_answer(data):
     answer = data.get('answer')
     
     if user_id and to_user_id and answer:
-        print(f'[CALL] User {user_id} sending answer to user {to_user_id}')
+        call_log.debug('User %s sending answer to user %s', user_id, to_user_id)
         user_room = f'user_{to_user_id}'
         socketio.emit('call_answer', {
             'from_user_id': user_id,
@@ -1215,6 +1506,50 @@ def on_call_ice_candidate(data):
             'candidate': candidate
         }, room=user_room)
 
+# Every handler is registered by now
+metrics.instrument_socketio(socketio)
+
+def metrics_authorized():
+    """/metrics and /debug need Authorization: Bearer <METRICS_TOKEN>; without METRICS_TOKEN they are off"""
+    token = os.environ.get('METRICS_TOKEN')
+    return bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Метрики в формате Prometheus"""
+    if not metrics_authorized():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    return metrics.REGISTRY.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+@app.route('/debug/locks', methods=['GET'])
+def get_lock_stats():
+    """Ожидание и удержание блокировок хранилища по местам вызова: ?limit="""
+    if not metrics_authorized():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    return jsonify(locks.report(max(1, min(request.args.get('limit', 20, type=int), 200)))), 200
+
+@app.route('/debug/locks/reset', methods=['POST'])
+def reset_lock_stats():
+    """Обнулить статистику блокировок"""
+    if not metrics_authorized():
+        return jsonify({'error': 'Доступ запрещен'}), 403
+    locks.reset()
+    return jsonify({'message': 'Статистика блокировок обнулена'}), 200
+
+def dump_lock_stats(interval):
+    """Log the hottest lock call sites every `interval` seconds"""
+    while True:
+        socketio.sleep(interval)
+        for site in locks.report(5)['sites']:
+            if site['contended']:
+                storage_log.info('Lock %s: %s waited %.3fs in %d of %d acquisitions (max %.3fs), held %.3fs',
+                                 site['lock'], site['site'], site['wait_total'], site['contended'],
+                                 site['acquisitions'], site['wait_max'], site['hold_total'])
+
+LOCK_STATS_DUMP_INTERVAL = float(os.environ.get('LOCK_STATS_DUMP_INTERVAL', 0))
+if LOCK_STATS_DUMP_INTERVAL > 0:
+    socketio.start_background_task(dump_lock_stats, LOCK_STATS_DUMP_INTERVAL)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_ENV') == 'development'
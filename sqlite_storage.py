@@ -0,0 +1,295 @@
+"""
+SQLite storage backend for RUCord
+
+Drop-in replacement for JSONStorage built on the standard library sqlite3
+module. Each collection is a table with an INTEGER PRIMARY KEY, one
+column per indexed field (see DEFAULT_INDEXES in storage.py) and the
+full item as JSON in `data`, so items round-trip exactly like with the
+JSON files. The database runs in WAL mode so other processes can read
+while one writes.
+
+Select it with RUCORD_STORAGE_BACKEND=sqlite. Existing JSON data is
+imported with:
+    
+    python sqlite_storage.py migrate [instance_dir] [db_path]
+"""
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from threading import RLock
+
+from locks import InstrumentedLock
+
+# Values sqlite3 can bind; lookups of others (lists, dicts from a request) match nothing
+_BINDABLE = (type(None), int, float, str, bytes)
+
+class SQLiteStorage:
+    """Thread-safe SQLite storage with the JSONStorage interface"""
+    
+    def __init__(self, db_path, indexes):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, exist_ok=True)
+        
+        # collection -> indexed fields stored as real columns
+        self.columns = {}
+        for collection, keys in indexes.items():
+            fields = []
+            for key in keys:
+                for field in (key if isinstance(key, tuple) else (key,)):
+                    if field not in fields:
+                        fields.append(field)
+            self.columns[collection] = fields
+        self.indexes = indexes
+        
+        self.locks = {collection: InstrumentedLock(collection) for collection in indexes}
+        
+        # One shared connection; sqlite3 objects must not be used concurrently
+        self._conn_lock = RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._init_storage()
+    
+    def _init_storage(self):
+        """Create tables and indexes if they don't exist"""
+        with self._conn_lock:
+            for collection, fields in self.columns.items():
+                columns = ''.join(f', "{field}"' for field in fields)
+                self._conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS "{collection}" '
+                    f'(id INTEGER PRIMARY KEY AUTOINCREMENT{columns}, data TEXT NOT NULL)'
+                )
+                # Fields indexed since the table was created get their column now
+                existing = {row[1] for row in self._conn.execute(f'PRAGMA table_info("{collection}")')}
+                for field in fields:
+                    if field not in existing:
+                        self._conn.execute(f'ALTER TABLE "{collection}" ADD COLUMN "{field}"')
+                        self._conn.execute(f'UPDATE "{collection}" SET "{field}" = json_extract(data, ?)', (f'$.{field}',))
+                for key in self.indexes[collection]:
+                    key = key if isinstance(key, tuple) else (key,)
+                    name = f'idx_{collection}_' + '_'.join(key)
+                    # Trailing id keeps index scans in id order for paging
+                    index_columns = ', '.join(f'"{field}"' for field in key) + ', id'
+                    self._conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{collection}" ({index_columns})')
+    
+    def _execute(self, sql, params=()):
+        with self._conn_lock:
+            return self._conn.execute(sql, params).fetchall()
+    
+    def _row_to_item(self, row):
+        item = json.loads(row[1])
+        item['id'] = row[0]
+        return item
+    
+    def _where(self, collection, fields):
+        """WHERE clause matching all field values (NULL-safe)"""
+        clauses = []
+        params = []
+        for field, value in fields.items():
+            if field == 'id' or field in self.columns[collection]:
+                clauses.append(f'"{field}" IS ?')
+            else:
+                clauses.append('json_extract(data, ?) IS ?')
+                params.append(f'$.{field}')
+            params.append(value)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+    
+    def _select(self, collection, fields=None, suffix='', extra_params=()):
+        if fields and not all(isinstance(value, _BINDABLE) for value in fields.values()):
+            return []
+        where, params = self._where(collection, fields or {})
+        rows = self._execute(f'SELECT id, data FROM "{collection}"{where}{suffix}', params + list(extra_params))
+        return [self._row_to_item(row) for row in rows]
+    
+    def _encode(self, collection, item):
+        """Column values and JSON data for an item"""
+        data = {k: v for k, v in item.items() if k != 'id'}
+        values = [item.get(field) for field in self.columns[collection]]
+        return values, json.dumps(data, ensure_ascii=False, default=str)
+    
+    def get_all(self, collection):
+        """Get all items from a collection"""
+        with self.locks[collection]:
+            return self._select(collection, suffix=' ORDER BY id')
+    
+    def get_by_id(self, collection, item_id):
+        """Get item by ID"""
+        return self.get_one_by_fields(collection, {'id': item_id})
+    
+    def get_many(self, collection, item_ids):
+        """Get several items by ID in one query, as {id: item} (missing IDs are left out)"""
+        item_ids = list({item_id for item_id in item_ids if isinstance(item_id, _BINDABLE)})
+        if not item_ids:
+            return {}
+        placeholders = ', '.join('?' for _ in item_ids)
+        with self.locks[collection]:
+            rows = self._execute(f'SELECT id, data FROM "{collection}" WHERE id IN ({placeholders})', item_ids)
+        return {row[0]: self._row_to_item(row) for row in rows}
+    
+    def get_by_field(self, collection, field, value):
+        """Get items by field value"""
+        return self.get_by_fields(collection, {field: value})
+    
+    def get_one_by_field(self, collection, field, value):
+        """Get one item by field value"""
+        return self.get_one_by_fields(collection, {field: value})
+    
+    def get_by_fields(self, collection, fields):
+        """Get items matching all of the given field values"""
+        with self.locks[collection]:
+            return self._select(collection, fields, ' ORDER BY id')
+    
+    def get_one_by_fields(self, collection, fields):
+        """Get one item matching all of the given field values"""
+        with self.locks[collection]:
+            items = self._select(collection, fields, ' ORDER BY id LIMIT 1')
+        return items[0] if items else None
+    
+    def get_page(self, collection, field, value, limit, before=None, after=None, around=None):
+        """Get up to `limit` items with field == value next to an id cursor.
+        
+        Same contract as JSONStorage.get_page: items oldest first, plus
+        whether more items exist past the page.
+        """
+        if around is not None:
+            older, more_older = self.get_page(collection, field, value, limit - limit // 2, before=around + 1)
+            newer, more_newer = self.get_page(collection, field, value, limit // 2, after=around)
+            return older + newer, more_older or more_newer
+        
+        fields = {field: value}
+        with self.locks[collection]:
+            if after is not None:
+                items = self._select(collection, fields, ' AND id > ? ORDER BY id LIMIT ?', (after, limit + 1))
+                return items[:limit], len(items) > limit
+            if before is not None:
+                items = self._select(collection, fields, ' AND id < ? ORDER BY id DESC LIMIT ?', (before, limit + 1))
+            else:
+                items = self._select(collection, fields, ' ORDER BY id DESC LIMIT ?', (limit + 1,))
+        items.reverse()
+        return items[max(len(items) - limit, 0):], len(items) > limit
+    
+    def get_latest(self, collection, field, value, limit):
+        """Get the newest `limit` items with field == value, oldest first"""
+        return self.get_page(collection, field, value, limit)[0]
+    
+    def get_after(self, collection, after_id):
+        """All items with id > after_id, oldest first"""
+        with self.locks[collection]:
+            return self._select(collection, None, ' WHERE id > ? ORDER BY id', (after_id,))
+    
+    def get_last_id(self, collection):
+        """Highest id stored in a collection (0 if it is empty)"""
+        return self._execute(f'SELECT COALESCE(MAX(id), 0) FROM "{collection}"')[0][0]
+    
+    def _insert(self, collection, item):
+        """INSERT one item. Must be called with the connection lock held."""
+        # Add timestamps if not present
+        if 'created_at' not in item:
+            item['created_at'] = datetime.utcnow().isoformat()
+        
+        values, data = self._encode(collection, item)
+        names = ['data'] + self.columns[collection]
+        params = [data] + values
+        if 'id' in item:
+            names.append('id')
+            params.append(item['id'])
+        columns = ', '.join(f'"{name}"' for name in names)
+        placeholders = ', '.join('?' for _ in names)
+        cursor = self._conn.execute(f'INSERT INTO "{collection}" ({columns}) VALUES ({placeholders})', params)
+        item['id'] = cursor.lastrowid
+    
+    def add(self, collection, item):
+        """Add new item to collection"""
+        with self.locks[collection]:
+            with self._conn_lock:
+                self._insert(collection, item)
+            return item
+    
+    def add_many(self, collection, items):
+        """Add several items in one transaction"""
+        with self.locks[collection]:
+            with self._conn_lock:
+                self._conn.execute('BEGIN')
+                try:
+                    for item in items:
+                        self._insert(collection, item)
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+            return items
+    
+    def update(self, collection, item_id, updates):
+        """Update item in collection.
+        
+        `updates` is a dict or a function of the current item returning
+        one. Read and write share one write transaction, so read-modify-write
+        updates from several processes are not lost. A function runs under
+        the collection lock and the connection lock and must not call
+        storage itself (that takes the locks in the other order and can
+        deadlock): read whatever else it needs before calling update.
+        """
+        with self.locks[collection]:
+            with self._conn_lock:
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    rows = self._conn.execute(f'SELECT id, data FROM "{collection}" WHERE id = ?', (item_id,)).fetchall()
+                    if not rows:
+                        self._conn.execute('COMMIT')
+                        return None
+                    item = self._row_to_item(rows[0])
+                    item.update(updates(dict(item)) if callable(updates) else updates)
+                    if 'updated_at' not in item:
+                        item['updated_at'] = datetime.utcnow().isoformat()
+                    values, data = self._encode(collection, item)
+                    assignments = ''.join(f', "{field}" = ?' for field in self.columns[collection])
+                    self._conn.execute(f'UPDATE "{collection}" SET data = ?{assignments} WHERE id = ?',
+                                       [data] + values + [item_id])
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+            return item
+    
+    def delete_before(self, collection, before_id):
+        """Delete items with id < before_id, for retention"""
+        with self.locks[collection]:
+            self._execute(f'DELETE FROM "{collection}" WHERE id < ?', (before_id,))
+            return True
+    
+    def delete(self, collection, item_id):
+        """Delete item from collection"""
+        return self.delete_by_field(collection, 'id', item_id)
+    
+    def delete_by_field(self, collection, field, value):
+        """Delete items by field value"""
+        where, params = self._where(collection, {field: value})
+        with self.locks[collection]:
+            self._execute(f'DELETE FROM "{collection}"{where}', params)
+            return True
+
+def migrate_from_json(storage_dir, db_path):
+    """Import every JSON collection into a SQLite database, keeping IDs"""
+    from storage import JSONStorage, DEFAULT_INDEXES
+    
+    source = JSONStorage(storage_dir, journal=False)
+    target = SQLiteStorage(db_path, DEFAULT_INDEXES)
+    for collection in DEFAULT_INDEXES:
+        if target.get_one_by_fields(collection, {}):
+            print(f"[MIGRATE] {collection}: table is not empty, skipped")
+            continue
+        items = sorted(source.get_all(collection), key=lambda i: i.get('id', 0))
+        target.add_many(collection, items)
+        print(f"[MIGRATE] {collection}: {len(items)} items")
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print('Usage: python sqlite_storage.py migrate [instance_dir] [db_path]')
+        sys.exit(1)
+    storage_dir = sys.argv[2] if len(sys.argv) > 2 else 'instance'
+    db_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(storage_dir, 'rucord.db')
+    migrate_from_json(storage_dir, db_path)
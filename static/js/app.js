@@ -2,6 +2,7 @@
 let currentUser = null;
 let authToken = null;
 let socket = null;
+let heartbeatTimer = null;
 let currentServer = null;
 let currentChannel = null;
 let currentDMChannel = null;
@@ -12,8 +13,19 @@ let friendRequests = { incoming: [], outgoing: [] };
 let dmChannels = [];
 let isHomeView = true;
 
+// Message history paging (cursor = id of the oldest loaded message)
+let oldestMessageId = null;
+let hasMoreMessages = false;
+let loadingOlderMessages = false;
+
+// Incremental sync: token of the last /api/sync, changes after it are fetched on reconnect
+let syncToken = null;
+let socketWasConnected = false;
+
 // API Base URL
 const API_BASE = '';
+const HEARTBEAT_INTERVAL = 30000; // Сервер считает сессию потерянной без heartbeat дольше 90 секунд
+const SEND_ACK_TIMEOUT = 5000; // Без подтверждения за это время сообщение повторно отправляется по HTTP
 
 // Cookie Functions
 function setCookie(name, value, days) {
@@ -538,6 +550,16 @@ function setupEventListeners() {
             if (e.target === modal) modal.style.display = 'none';
         });
     });
+    
+    // Подгрузка старых сообщений при прокрутке вверх
+    const messagesContainer = document.getElementById('messagesContainer');
+    if (messagesContainer) {
+        messagesContainer.addEventListener('scroll', () => {
+            if (messagesContainer.scrollTop < 200) {
+                loadOlderMessages();
+            }
+        });
+    }
 }
 
 // Tab Switching
@@ -646,6 +668,9 @@ async function checkAuth() {
             showApp();
             showHomeView();
             
+            // Токен берём до загрузки: всё, что изменится после, придёт при синхронизации
+            await syncChanges();
+            
             // Загружаем данные асинхронно (не ждем их завершения, loader скроется в initRouter)
             loadServers();
             loadFriends();
@@ -840,11 +865,6 @@ function showApp() {
         if (userId) userId.textContent = `#${String(currentUser.id).padStart(4, '0')}`;
         
         updateUserStatus(currentUser.status || 'online');
-        
-        // Обновляем статус на сервере
-        if (!currentUser.status || currentUser.status === 'offline') {
-            updateUserStatusOnServer('online');
-        }
     }
 }
 
@@ -1455,6 +1475,21 @@ async function handleCreateChannel(e) {
 }
 
 // Messages
+function getMessagesUrl() {
+    if (currentChannel) {
+        return `${API_BASE}/api/channels/${currentChannel.id}/messages`;
+    }
+    if (currentDMChannel) {
+        return `${API_BASE}/api/dm-channels/${currentDMChannel.id}/messages`;
+    }
+    return null;
+}
+
+function setMessagesPage(page) {
+    hasMoreMessages = page.has_more;
+    oldestMessageId = page.messages.length > 0 ? page.messages[0].id : null;
+}
+
 async function loadMessages() {
     if (currentChannel) {
         try {
@@ -1463,8 +1498,9 @@ async function loadMessages() {
             });
             
             if (response.ok) {
-                const messages = await response.json();
-                renderMessages(messages);
+                const page = await response.json();
+                setMessagesPage(page);
+                renderMessages(page.messages);
             }
         } catch (error) {
             console.error('Failed to load messages:', error);
@@ -1472,6 +1508,30 @@ async function loadMessages() {
     }
 }
 
+// Загрузка предыдущей страницы истории (курсор before = id самого старого сообщения)
+async function loadOlderMessages() {
+    const url = getMessagesUrl();
+    if (!url || !hasMoreMessages || loadingOlderMessages || oldestMessageId === null) return;
+    
+    loadingOlderMessages = true;
+    try {
+        const response = await fetch(`${url}?before=${oldestMessageId}`, {
+            headers: { 'Authorization': `Bearer ${authToken}` }
+        });
+        
+        // Пока шел запрос пользователь мог переключить канал
+        if (response.ok && url === getMessagesUrl()) {
+            const page = await response.json();
+            setMessagesPage(page);
+            prependMessages(page.messages);
+        }
+    } catch (error) {
+        console.error('Failed to load older messages:', error);
+    } finally {
+        loadingOlderMessages = false;
+    }
+}
+
 function renderMessages(messages) {
     const container = document.getElementById('messagesContainer');
     container.innerHTML = '';
@@ -1485,53 +1545,76 @@ function renderMessages(messages) {
     let lastAuthorId = null;
     
     messages.forEach(message => {
-        const messageDiv = document.createElement('div');
-        messageDiv.className = 'message';
-        
         const showAvatar = lastAuthorId !== message.user_id;
         lastAuthorId = message.user_id;
-        
-        const avatar = document.createElement('div');
-        avatar.className = 'message-avatar';
-        if (showAvatar) {
-            avatar.textContent = message.user.username[0].toUpperCase();
-            avatar.classList.remove('hidden-avatar');
-        } else {
-            avatar.style.width = '0';
-            avatar.style.visibility = 'hidden';
-            avatar.classList.add('hidden-avatar');
-        }
-        
-        const content = document.createElement('div');
-        content.className = 'message-content';
-        
-        const header = document.createElement('div');
-        header.className = 'message-header';
-        
-        if (showAvatar) {
-            const author = document.createElement('span');
-            author.className = 'message-author';
-            author.textContent = message.user.username;
-            header.appendChild(author);
-        }
-        
-    // Timestamp already added above
-        
-        const text = document.createElement('div');
-        text.className = 'message-text';
-        text.textContent = message.content;
-        
-        content.appendChild(header);
-        content.appendChild(text);
-        
-        messageDiv.appendChild(avatar);
-        messageDiv.appendChild(content);
-        container.appendChild(messageDiv);
+        container.appendChild(createMessageElement(message, showAvatar));
     });
     
     container.scrollTop = container.scrollHeight;
 }
 
+function prependMessages(messages) {
+    const container = document.getElementById('messagesContainer');
+    if (!container || messages.length === 0) return;
+    
+    const fragment = document.createDocumentFragment();
+    let lastAuthorId = null;
+    
+    messages.forEach(message => {
+        const showAvatar = lastAuthorId !== message.user_id;
+        lastAuthorId = message.user_id;
+        fragment.appendChild(createMessageElement(message, showAvatar));
+    });
+    
+    // Сохраняем позицию прокрутки, чтобы видимые сообщения не прыгали
+    const previousHeight = container.scrollHeight;
+    container.insertBefore(fragment, container.firstChild);
+    container.scrollTop += container.scrollHeight - previousHeight;
+}
+
+function createMessageElement(message, showAvatar) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = 'message';
+    messageDiv.dataset.messageId = message.id;
+    
+    const avatar = document.createElement('div');
+    avatar.className = 'message-avatar';
+    if (showAvatar) {
+        avatar.textContent = message.user.username[0].toUpperCase();
+        avatar.classList.remove('hidden-avatar');
+    } else {
+        avatar.style.width = '0';
+        avatar.style.visibility = 'hidden';
+        avatar.classList.add('hidden-avatar');
+    }
+    
+    const content = document.createElement('div');
+    content.className = 'message-content';
+    
+    const header = document.createElement('div');
+    header.className = 'message-header';
+    
+    if (showAvatar) {
+        const author = document.createElement('span');
+        author.className = 'message-author';
+        author.textContent = message.user.username;
+        header.appendChild(author);
+    }
+    
+    // Timestamp already added above
+    
+    const text = document.createElement('div');
+    text.className = 'message-text';
+    text.textContent = message.content;
+    
+    content.appendChild(header);
+    content.appendChild(text);
+    
+    messageDiv.appendChild(avatar);
+    messageDiv.appendChild(content);
+    return messageDiv;
+}
+
 async function handleSendMessage(e) {
     e.preventDefault();
     const input = document.getElementById('messageInput');
@@ -1552,6 +1635,26 @@ async function handleSendMessage(e) {
         return;
     }
     
+    // Один nonce на сообщение: повтор по HTTP не создаст дубликат
+    const nonce = generateNonce();
+    const payload = channelId
+        ? { channel_id: channelId, content, nonce }
+        : { dm_channel_id: dmChannelId, content, nonce };
+    
+    if (socket && socket.connected) {
+        const ack = await sendMessageOverSocket(payload);
+        if (ack && ack.message) {
+            input.value = '';
+            addMessageToView(ack.message);
+            return;
+        }
+        if (ack && ack.error) {
+            alert('Ошибка отправки сообщения: ' + ack.error);
+            return;
+        }
+        console.warn('[SOCKET] No ack for send_message, falling back to HTTP');
+    }
+    
     try {
         const url = channelId 
             ? `${API_BASE}/api/channels/${channelId}/messages`
@@ -1565,7 +1668,7 @@ async function handleSendMessage(e) {
                 'Content-Type': 'application/json',
                 'Authorization': `Bearer ${authToken}`
             },
-            body: JSON.stringify({ content })
+            body: JSON.stringify({ content, nonce })
         });
         
         if (response.ok) {
@@ -1586,6 +1689,22 @@ async function handleSendMessage(e) {
     }
 }
 
+function generateNonce() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+}
+
+// Ответ сервера на send_message или null, если подтверждение не пришло вовремя
+function sendMessageOverSocket(payload) {
+    return new Promise((resolve) => {
+        socket.timeout(SEND_ACK_TIMEOUT).emit('send_message', payload, (err, ack) => {
+            resolve(err ? null : ack);
+        });
+    });
+}
+
 function formatTimestamp(dateString) {
     const date = new Date(dateString);
     const now = new Date();
@@ -1606,6 +1725,11 @@ function addMessageToView(message) {
     const container = document.getElementById('messagesContainer');
     if (!container) return;
     
+    // Своё сообщение приходит и в ответе на отправку, и в рассылке комнаты
+    if (message.id && container.querySelector(`.message[data-message-id="${message.id}"]`)) {
+        return;
+    }
+    
     const emptyState = container.querySelector('.empty-state');
     if (emptyState) {
         container.innerHTML = '';
@@ -1613,6 +1737,9 @@ function addMessageToView(message) {
     
     const messageDiv = document.createElement('div');
     messageDiv.className = 'message';
+    if (message.id) {
+        messageDiv.dataset.messageId = message.id;
+    }
     
     // Определяем текущего автора
     const currentAuthor = message.user?.username || message.user_name || 'Неизвестно';
@@ -1832,10 +1959,14 @@ function getStatusText(status) {
     return statusMap[status] || 'Не в сети';
 }
 
+// Последний отправленный запрос: ответы на более старые запросы отбрасываются
+let latestUserSearch = '';
+
 async function handleFriendSearch(e) {
     const query = e.target.value.trim();
     const resultsDiv = document.getElementById('userSearchResults');
     resultsDiv.innerHTML = '';
+    latestUserSearch = query;
     
     if (query.length < 2) {
         return;
@@ -1848,6 +1979,7 @@ async function handleFriendSearch(e) {
         
         if (response.ok) {
             const users = await response.json();
+            if (query !== latestUserSearch) return;
             if (users.length === 0) {
                 resultsDiv.innerHTML = '<div class="empty-state">Пользователи не найдены</div>';
                 return;
@@ -2088,8 +2220,22 @@ function renderDMChannels() {
         
         info.appendChild(name);
         
+        if (dmChannel.last_message) {
+            const preview = document.createElement('div');
+            preview.className = 'friend-status';
+            preview.textContent = dmChannel.last_message.content;
+            info.appendChild(preview);
+        }
+        
         item.appendChild(avatar);
         item.appendChild(info);
+        
+        if (dmChannel.unread_count > 0) {
+            const unread = document.createElement('span');
+            unread.className = 'dm-unread';
+            unread.textContent = dmChannel.unread_count > 99 ? '99+' : dmChannel.unread_count;
+            item.appendChild(unread);
+        }
         item.onclick = () => selectDMChannel(dmChannel);
         
         list.appendChild(item);
@@ -2210,14 +2356,120 @@ async function loadDMMessages() {
         });
         
         if (response.ok) {
-            const messages = await response.json();
-            renderMessages(messages);
+            const page = await response.json();
+            setMessagesPage(page);
+            renderMessages(page.messages);
+            markDMRead(currentDMChannel.id);
         }
     } catch (error) {
         console.error('Failed to load DM messages:', error);
     }
 }
 
+// Отмечает ЛС прочитанными до последнего сообщения и обновляет счётчик в списке
+async function markDMRead(dmChannelId) {
+    try {
+        const response = await fetch(`${API_BASE}/api/dm-channels/${dmChannelId}/read`, {
+            method: 'POST',
+            headers: { 'Authorization': `Bearer ${authToken}` }
+        });
+        if (response.ok) {
+            const summary = await response.json();
+            const dmChannel = dmChannels.find(c => c.id === dmChannelId);
+            if (dmChannel && dmChannel.unread_count !== summary.unread_count) {
+                dmChannel.unread_count = summary.unread_count;
+                renderDMChannels();
+            }
+        }
+    } catch (error) {
+        console.error('Failed to mark DM as read:', error);
+    }
+}
+
+// Новые ЛС: открытый канал сразу отмечается прочитанным, затем обновляется список
+async function refreshDMChannels(messages) {
+    if (currentDMChannel && messages.some(message => message.dm_channel_id === currentDMChannel.id)) {
+        await markDMRead(currentDMChannel.id);
+    }
+    loadDMChannels();
+}
+
+// Incremental sync
+async function syncChanges() {
+    try {
+        const url = syncToken
+            ? `${API_BASE}/api/sync?since=${encodeURIComponent(syncToken)}`
+            : `${API_BASE}/api/sync`;
+        const response = await fetch(url, {
+            headers: { 'Authorization': `Bearer ${authToken}` }
+        });
+        if (!response.ok) return;
+        
+        const delta = await response.json();
+        const hadToken = syncToken !== null;
+        syncToken = delta.token;
+        if (delta.reset) {
+            // Сервер не может продолжить с нашего токена - загружаем всё заново
+            if (hadToken) reloadAllData();
+            return;
+        }
+        applySyncDelta(delta);
+    } catch (error) {
+        console.error('Failed to sync:', error);
+    }
+}
+
+function reloadAllData() {
+    loadServers();
+    loadFriends();
+    loadDMChannels();
+    loadFriendRequests();
+    if (currentServer) loadChannels();
+    if (currentChannel) loadMessages();
+    if (currentDMChannel) loadDMMessages();
+}
+
+function applySyncDelta(delta) {
+    const kinds = new Set(delta.changes.map(change => change.kind));
+    
+    if (kinds.has('server_joined') || kinds.has('member_joined') || kinds.has('channel_created')) {
+        loadServers();
+    }
+    if (currentServer && delta.changes.some(change => change.kind === 'channel_created' && change.data.server_id === currentServer.id)) {
+        loadChannels();
+    }
+    if (['friend_request', 'friend_added', 'friend_request_declined', 'friend_removed'].some(kind => kinds.has(kind))) {
+        loadFriends();
+        loadFriendRequests();
+    }
+    
+    const truncated = delta.truncated.some(target =>
+        (currentChannel && target.channel_id === currentChannel.id) ||
+        (currentDMChannel && target.dm_channel_id === currentDMChannel.id));
+    if (truncated) {
+        if (currentChannel) loadMessages();
+        if (currentDMChannel) loadDMMessages();
+    } else {
+        delta.messages.forEach((message) => {
+            if ((currentChannel && message.channel_id === currentChannel.id) ||
+                (currentDMChannel && message.dm_channel_id === currentDMChannel.id)) {
+                addMessageToView(message);
+            }
+        });
+    }
+    if (kinds.has('dm_channel_created') || delta.messages.some(message => message.dm_channel_id)) {
+        refreshDMChannels(delta.messages);
+    }
+    
+    if (delta.users.some(user => friends.find(f => f.id === user.id))) {
+        loadFriends();
+    }
+    const me = delta.users.find(user => user.id === currentUser?.id);
+    if (me) {
+        updateUserStatus(me.status);
+    }
+}
+
 // Settings Functions
 async function loadSettings() {
     try {
@@ -2311,10 +2563,16 @@ function initSocket() {
         transports: ['websocket', 'polling']
     });
     
+    socketWasConnected = false;
     socket.on('connect', () => {
         console.log('[SOCKET] WebSocket connected');
         console.log('[SOCKET] Socket ID:', socket.id);
-        updateUserStatusOnServer('online');
+        
+        // После переподключения догружаем только то, что изменилось
+        if (socketWasConnected) {
+            syncChanges();
+        }
+        socketWasConnected = true;
         
         if (currentChannel) {
             socket.emit('join_channel', { channel_id: currentChannel.id });
@@ -2328,6 +2586,15 @@ function initSocket() {
         console.log('[SOCKET] Server confirmed connection:', data);
     });
     
+    if (heartbeatTimer) {
+        clearInterval(heartbeatTimer);
+    }
+    heartbeatTimer = setInterval(() => {
+        if (socket && socket.connected) {
+            socket.emit('heartbeat');
+        }
+    }, HEARTBEAT_INTERVAL);
+    
     socket.on('disconnect', () => {
         console.log('WebSocket disconnected');
     });
@@ -2342,7 +2609,25 @@ function initSocket() {
         if (currentDMChannel && message.dm_channel_id === currentDMChannel.id) {
             addMessageToView(message);
         }
-        loadDMChannels();
+        refreshDMChannels([message]);
+    });
+    
+    // Сообщения, отправленные через сокет, приходят пачками
+    socket.on('new_messages', (messages) => {
+        messages.forEach((message) => {
+            if (currentChannel && message.channel_id === currentChannel.id) {
+                addMessageToView(message);
+            }
+        });
+    });
+    
+    socket.on('new_dm_messages', (messages) => {
+        messages.forEach((message) => {
+            if (currentDMChannel && message.dm_channel_id === currentDMChannel.id) {
+                addMessageToView(message);
+            }
+        });
+        refreshDMChannels(messages);
     });
     
     socket.on('friend_request_received', (request) => {
@@ -3,138 +3,1179 @@ JSON-based storage system for RUCord
 """
 import json
 import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
 from datetime import datetime
 from threading import Lock
 import bcrypt
 
+import metrics
+from locks import InstrumentedLock
+from logs import get_logger
+
+# Optional faster codecs
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class JSONCodec:
+    """Compact UTF-8 JSON, encoded with orjson when it is installed"""
+    name = 'json'
+    extension = '.json'
+    
+    def dumps(self, data):
+        if orjson is not None:
+            return orjson.dumps(data, default=str, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+    
+    def loads(self, raw):
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw)
+
+class MsgpackCodec:
+    """Binary MessagePack snapshots (requires the msgpack package)"""
+    name = 'msgpack'
+    extension = '.msgpack'
+    
+    def dumps(self, data):
+        return msgpack.packb(data, default=str, use_bin_type=True)
+    
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+CODECS = {'json': JSONCodec(), 'msgpack': MsgpackCodec()}
+
+log = get_logger('storage')
+
+# op is read, parse, write, lock_wait or lock_hold; bytes are counted for read and write
+_op_seconds = metrics.histogram('rucord_storage_seconds', 'JSONStorage file and lock time', ('collection', 'op'))
+_op_bytes = metrics.counter('rucord_storage_bytes_total', 'JSONStorage bytes read and written', ('collection', 'op'))
+_fsync_seconds = metrics.histogram('rucord_storage_fsync_seconds', 'Group commit flush time')
+
+def _timed(collection, op, started, size=None):
+    """Record an operation that began at `started` (perf_counter) and its size in bytes"""
+    _op_seconds.labels(collection, op).observe(time.perf_counter() - started)
+    if size is not None:
+        _op_bytes.labels(collection, op).inc(size)
+
+def _detect_codec(raw):
+    """Codec a snapshot was written with, judging by its first byte"""
+    if raw.lstrip()[:1] in (b'[', b'{', b''):
+        return CODECS['json']
+    return CODECS['msgpack']
+
+# Journals and segments are always JSON lines
+_line_codec = CODECS['json']
+
+# Hash indexes maintained for every collection. A tuple declares a
+# composite index that answers lookups on all of its fields at once.
+DEFAULT_INDEXES = {
+    'users': ['username', 'email'],
+    'user_settings': ['user_id'],
+    'servers': ['owner_id'],
+    'server_members': ['user_id', 'server_id', ('user_id', 'server_id')],
+    'channels': ['server_id'],
+    'messages': ['channel_id', 'dm_channel_id'],
+    'friend_requests': ['from_user_id', 'to_user_id'],
+    'friendships': ['user1_id', 'user2_id', ('user1_id', 'user2_id')],
+    'dm_channels': ['user1_id', 'user2_id', ('user1_id', 'user2_id')],
+    'changes': ['user_id', 'server_id'],
+    'presence': ['worker']
+}
+
+# Collections split into one directory per partition key value. An item
+# goes to the partition of the first key it has a value for.
+DEFAULT_PARTITIONS = {
+    'messages': ('channel_id', 'dm_channel_id'),
+    'changes': ('user_id', 'server_id')
+}
+
+# Items moved per append when splitting a collection into partitions
+MIGRATION_CHUNK = 10000
+
+def _path_signature(path):
+    """Cheap change marker for a file or directory (mtime and size)"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _read_jsonl(path, collection):
+    """Read JSON lines, cutting off a torn trailing line left by a crash.
+    
+    Only a last line without its newline counts as torn. A line that does
+    not decode anywhere else means the file is damaged: CorruptedFileError.
+    """
+    records = []
+    started = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return records
+    _timed(collection, 'read', started, len(raw))
+    
+    started = time.perf_counter()
+    good = 0
+    for number, line in enumerate(raw.splitlines(keepends=True), 1):
+        if not line.endswith(b'\n'):
+            break
+        try:
+            records.append(_line_codec.loads(line))
+        except ValueError as e:
+            raise CorruptedFileError(f'{path} is damaged at line {number} ({e}); '
+                                     f'restore it or remove the damaged line') from e
+        good += len(line)
+    _timed(collection, 'parse', started)
+    if good < len(raw):
+        log.warning('Dropping a torn record (%d bytes) at the end of %s', len(raw) - good, path)
+        with open(path, 'r+b') as f:
+            f.truncate(good)
+    return records
+
+def _encode_jsonl(records):
+    return b''.join(_line_codec.dumps(r) + b'\n' for r in records)
+
+def _append_jsonl(path, records, collection):
+    """Append records as JSON lines; returns True if the file was new"""
+    started = time.perf_counter()
+    data = _encode_jsonl(records)
+    with open(path, 'ab') as f:
+        created = f.tell() == 0
+        f.write(data)
+    _timed(collection, 'write', started, len(data))
+    return created
+
+def _fsync_file(path):
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+        # Renamed or removed since it was written (compaction syncs before rotating)
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_dir(path):
+    """Make new or renamed directory entries durable (no-op where unsupported)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _fsync_all(files, dirs):
+    for path in files:
+        _fsync_file(path)
+    for path in dirs:
+        _fsync_dir(path)
+
+def _eventlet_patched():
+    """Whether eventlet monkey patched the process (gunicorn's eventlet worker does)"""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched('thread')
+
+def _write_durable(path, data, durable=True):
+    with open(path, 'wb') as f:
+        f.write(data)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+
+def _atomic_write(path, data, durable=True):
+    """Replace a file through a temp file and rename.
+    
+    Readers and a crash at any point see either the old or the new
+    content, never a truncated file.
+    """
+    tmp_path = path + '.tmp'
+    _write_durable(tmp_path, data, durable)
+    os.replace(tmp_path, path)
+    if durable:
+        _fsync_dir(os.path.dirname(path) or '.')
+
+class CorruptedFileError(RuntimeError):
+    """A storage file exists but cannot be decoded"""
+
+class _GroupCommit:
+    """Batches the fsyncs of concurrent writers (group commit).
+    
+    Writers append under their collection lock, register the file with
+    written() and, after releasing the lock, block in wait() until the
+    data is on disk. One waiter at a time becomes the leader: it sleeps
+    `window` seconds so writers arriving meanwhile join the batch, then
+    fsyncs every file written so far once and wakes the others; those
+    whose writes were covered return without touching the disk.
+    
+    With `green` (eventlet) the fsyncs and other blocking disk writes
+    passed to run() go to eventlet.tpool's native threads, so the hub
+    keeps serving other clients meanwhile.
+    """
+    
+    def __init__(self, window=0.002, enabled=True, green=False):
+        self.window = window
+        self.enabled = enabled
+        self.green = green
+        if green:
+            from eventlet import tpool
+            self._tpool = tpool
+        # Guards the files written since the last flush
+        self.lock = Lock()
+        self.files = set()
+        self.dirs = set()
+        self.written_seq = 0
+        # Guards the flush state; waiters sleep on it while a leader flushes
+        self.cond = threading.Condition(Lock())
+        self.flushing = False
+        self.synced_seq = 0
+    
+    def written(self, path, dirs=()):
+        """Register an append to path (and new entries in dirs); returns a ticket for wait()"""
+        if not self.enabled:
+            return 0
+        with self.lock:
+            self.files.add(path)
+            self.dirs.update(dirs)
+            self.written_seq += 1
+            return self.written_seq
+    
+    def wait(self, ticket):
+        """Block until every write up to `ticket` is durable"""
+        with self.cond:
+            while self.synced_seq < ticket:
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                self.flushing = True
+                self.cond.release()
+                synced = None
+                try:
+                    synced = self._flush()
+                finally:
+                    self.cond.acquire()
+                    if synced is not None:
+                        self.synced_seq = synced
+                    self.flushing = False
+                    self.cond.notify_all()
+    
+    def run(self, function, *args):
+        """Call a blocking disk function, on a native thread under eventlet"""
+        if self.green:
+            return self._tpool.execute(function, *args)
+        return function(*args)
+    
+    def _flush(self):
+        """Fsync everything written so far; returns the last ticket covered"""
+        if self.window:
+            time.sleep(self.window)
+        with self.lock:
+            files, dirs, target = self.files, self.dirs, self.written_seq
+            self.files, self.dirs = set(), set()
+        started = time.perf_counter()
+        try:
+            self.run(_fsync_all, files, dirs)
+            _fsync_seconds.observe(time.perf_counter() - started)
+        except Exception:
+            with self.lock:
+                self.files |= files
+                self.dirs |= dirs
+            raise
+        return target
+
+def _item_id(item):
+    return item.get('id', 0)
+
+def _hashable(value):
+    """Whether a value can be an index key; lookups of other values (lists, dicts from a request) match nothing"""
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+def _index_value(item, key):
+    if isinstance(key, tuple):
+        return tuple(item.get(field) for field in key)
+    return item.get(key)
+
+class _Collection:
+    """Resident copy of one collection (snapshot plus replayed journal)"""
+    
+    def __init__(self, items, signature, index_keys=()):
+        self.by_id = {}
+        # index key -> field value -> {id: item}, in insertion order
+        self.indexes = {key: {} for key in index_keys}
+        for item in items:
+            self.put(item)
+        self.signature = signature
+        # Journal records appended since the last snapshot
+        self.journal_records = 0
+    
+    @property
+    def items(self):
+        return self.by_id.values()
+    
+    def put(self, item):
+        """Insert or replace an item, keeping the indexes in step"""
+        item_id = item.get('id')
+        old = self.by_id.get(item_id)
+        self.by_id[item_id] = item
+        for key, index in self.indexes.items():
+            value = _index_value(item, key)
+            if old is not None:
+                old_value = _index_value(old, key)
+                if old_value != value:
+                    self._unindex(index, old_value, item_id)
+            index.setdefault(value, {})[item_id] = item
+    
+    def remove(self, item_id):
+        item = self.by_id.pop(item_id, None)
+        if item is not None:
+            for key, index in self.indexes.items():
+                self._unindex(index, _index_value(item, key), item_id)
+        return item
+    
+    def _unindex(self, index, value, item_id):
+        bucket = index.get(value)
+        if bucket is not None:
+            bucket.pop(item_id, None)
+            if not bucket:
+                del index[value]
+    
+    def find(self, fields):
+        """Items matching all field values, using the best available index"""
+        if len(fields) == 1:
+            (field, value), = fields.items()
+            if field in self.indexes:
+                return self.indexes[field].get(value, {}).values()
+        for key, index in self.indexes.items():
+            if isinstance(key, tuple) and set(key) == set(fields):
+                return index.get(tuple(fields[f] for f in key), {}).values()
+        candidates = self.items
+        for field, value in fields.items():
+            if field in self.indexes:
+                candidates = self.indexes[field].get(value, {}).values()
+                break
+        return [item for item in candidates
+                if all(item.get(f) == v for f, v in fields.items())]
+    
+    def apply(self, record):
+        """Apply one journal record"""
+        if record.get('op') == 'put':
+            self.put(record['item'])
+        elif record.get('op') == 'del':
+            self.remove(record['id'])
+
+class _IdSequence:
+    """Persistent monotonic ID counter for one collection.
+    
+    IDs are reserved on disk in blocks, so allocating one is O(1) and only
+    every `block`-th allocation rewrites the sequence file. IDs are never
+    reused, not even after deleting the newest item; after a crash the
+    unused rest of the reserved block is skipped. Because they only grow,
+    IDs sort in creation order and work as pagination cursors.
+    """
+    
+    def __init__(self, path, floor, block, durable, commits):
+        self.path = path
+        self.block = block
+        self.durable = durable
+        self.commits = commits
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.reserved = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            self.reserved = 0
+        self.last = max(self.reserved, floor)
+    
+    def observe(self, item_id):
+        """Make sure an ID assigned elsewhere is never handed out"""
+        if isinstance(item_id, int) and item_id > self.last:
+            self.last = item_id
+    
+    def next(self):
+        self.last += 1
+        if self.last > self.reserved:
+            reserved = self.last + self.block - 1
+            self.commits.run(_atomic_write, self.path, str(reserved).encode('utf-8'), self.durable)
+            self.reserved = reserved
+        return self.last
+
+class _Partition:
+    """Segment list and cached newest segment of one partition"""
+    
+    def __init__(self, path, segments, tail, signature):
+        self.path = path
+        self.segments = segments
+        # Id of the first item of each segment, for bisecting by cursor
+        self.first_ids = [int(name.split('.')[0]) for name in segments]
+        self.tail = tail
+        self.signature = signature
+
+class _SegmentedCollection:
+    """Collection stored as one directory per partition (e.g. per channel).
+    
+    A partition is a sequence of JSONL segment files named after the id of
+    their first item, each holding at most segment_size items in append
+    order. Appends and "latest N" reads only touch the newest segment of a
+    single partition. Callers hold the collection lock.
+    """
+    
+    def __init__(self, root, keys, segment_size=1000, resident=True, commits=None):
+        self.root = root
+        self.name = os.path.basename(root)
+        self.keys = keys
+        self.segment_size = segment_size
+        self.resident = resident
+        self.commits = commits or _GroupCommit(enabled=False)
+        self.partitions = {}
+        os.makedirs(root, exist_ok=True)
+        self.last_id = 0
+        for name in self._partition_names():
+            tail = self._load(name).tail
+            if tail:
+                self.last_id = max(self.last_id, tail[-1].get('id', 0))
+    
+    def _partition_names(self):
+        return sorted(name for name in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, name)))
+    
+    def partition_name(self, fields):
+        """Partition of an item (or of a lookup), None if it has no partition key"""
+        for key in self.keys:
+            if fields.get(key) is not None:
+                return f'{key[:-len("_id")]}_{fields[key]}'
+        return None
+    
+    def _signature(self, path, segments):
+        tail_signature = _path_signature(os.path.join(path, segments[-1])) if segments else None
+        return (_path_signature(path), tail_signature)
+    
+    def _load(self, name):
+        path = os.path.join(self.root, name)
+        part = self.partitions.get(name)
+        if part is not None and part.signature == self._signature(path, part.segments):
+            return part
+        segments = sorted(f for f in os.listdir(path) if f.endswith('.jsonl')) if os.path.isdir(path) else []
+        tail = _read_jsonl(os.path.join(path, segments[-1]), self.name) if segments else []
+        part = _Partition(path, segments, tail, self._signature(path, segments))
+        if self.resident:
+            self.partitions[name] = part
+        return part
+    
+    def _read_segment(self, part, index):
+        if index == len(part.segments) - 1:
+            return part.tail
+        return _read_jsonl(os.path.join(part.path, part.segments[index]), self.name)
+    
+    def _write_segment(self, part, index, items):
+        path = os.path.join(part.path, part.segments[index])
+        started = time.perf_counter()
+        data = _encode_jsonl(items)
+        self.commits.run(_atomic_write, path, data, self.commits.enabled)
+        _timed(self.name, 'write', started, len(data))
+        if index == len(part.segments) - 1:
+            part.tail = items
+        part.signature = self._signature(part.path, part.segments)
+    
+    def _scan(self, names=None):
+        """Yield (partition, segment index, items) over the given partitions"""
+        for name in (self._partition_names() if names is None else names):
+            part = self._load(name)
+            for index in range(len(part.segments)):
+                yield part, index, self._read_segment(part, index)
+    
+    def append(self, item):
+        """Append an item to the newest segment of its partition; returns a commit ticket"""
+        return self.append_many([item])
+    
+    def append_many(self, items):
+        """Append items in order with one write per touched segment; returns a commit ticket"""
+        parts = {}
+        writes = {}
+        dirs = []
+        for item in items:
+            name = self.partition_name(item) or 'other'
+            part = parts.get(name) or self._load(name)
+            parts[name] = part
+            if not part.segments or len(part.tail) >= self.segment_size:
+                if not os.path.isdir(part.path):
+                    os.makedirs(part.path, exist_ok=True)
+                    dirs.append(self.root)
+                part.segments.append(f"{item['id']:012d}.jsonl")
+                part.first_ids.append(item['id'])
+                part.tail = []
+                dirs.append(part.path)
+            writes.setdefault(os.path.join(part.path, part.segments[-1]), []).append(item)
+            part.tail.append(item)
+            self.last_id = max(self.last_id, item['id'])
+        
+        ticket = 0
+        try:
+            for path, chunk in writes.items():
+                _append_jsonl(path, chunk, self.name)
+                ticket = self.commits.written(path, dirs)
+                dirs = []
+        except Exception:
+            # The cached tails are ahead of the files now; re-read them next time
+            for name in parts:
+                self.partitions.pop(name, None)
+            raise
+        for part in parts.values():
+            part.signature = self._signature(part.path, part.segments)
+        return ticket
+    
+    def page(self, name, limit, before=None, after=None):
+        """Up to `limit` items of a partition next to an id cursor, oldest first.
+        
+        Without a cursor (or with `before`) returns the newest items older
+        than the cursor; with `after` the oldest items newer than it. Only
+        the segments around the cursor are read. Also returns whether more
+        items exist past the page in the same direction.
+        """
+        part = self._load(name)
+        result = []
+        if after is not None:
+            index = max(bisect_right(part.first_ids, after) - 1, 0)
+            while index < len(part.segments) and len(result) <= limit:
+                items = self._read_segment(part, index)
+                start = bisect_right(items, after, key=_item_id)
+                result.extend(items[start:start + limit + 1 - len(result)])
+                index += 1
+            return result[:limit], len(result) > limit
+        
+        if before is None:
+            index = len(part.segments) - 1
+        else:
+            index = bisect_left(part.first_ids, before) - 1
+        while index >= 0 and len(result) <= limit:
+            items = self._read_segment(part, index)
+            end = len(items) if before is None else bisect_left(items, before, key=_item_id)
+            result = items[max(end - (limit + 1 - len(result)), 0):end] + result
+            index -= 1
+        return result[max(len(result) - limit, 0):], len(result) > limit
+    
+    def after(self, after_id):
+        """Items of all partitions with id > after_id, reading only the segments that can hold them"""
+        result = []
+        for name in self._partition_names():
+            part = self._load(name)
+            for index in range(max(bisect_right(part.first_ids, after_id) - 1, 0), len(part.segments)):
+                items = self._read_segment(part, index)
+                result.extend(items[bisect_right(items, after_id, key=_item_id):])
+        return result
+    
+    def find(self, fields):
+        name = self.partition_name(fields)
+        names = None if name is None else [name]
+        return [item for _, _, items in self._scan(names) for item in items
+                if all(item.get(f) == v for f, v in fields.items())]
+    
+    def all(self):
+        return [item for _, _, items in self._scan() for item in items]
+    
+    def drop_before(self, before_id):
+        """Delete the segments holding only items with id < before_id.
+        
+        The newest segment of a partition is always kept, as are older
+        items sharing a segment with newer ones. Returns the number of
+        segments deleted.
+        """
+        dropped = 0
+        for name in self._partition_names():
+            part = self._load(name)
+            # Segment i holds ids below first_ids[i + 1]
+            keep = max(bisect_right(part.first_ids, before_id) - 1, 0)
+            keep = min(keep, len(part.segments) - 1)
+            if keep <= 0:
+                continue
+            for segment in part.segments[:keep]:
+                os.remove(os.path.join(part.path, segment))
+            del part.segments[:keep]
+            del part.first_ids[:keep]
+            part.signature = self._signature(part.path, part.segments)
+            dropped += keep
+        return dropped
+    
+    def replace(self, item_id, update):
+        """Rewrite the segment holding item_id with update(item) (None deletes it)"""
+        for part, index, items in self._scan():
+            for position, item in enumerate(items):
+                if item.get('id') == item_id:
+                    items = list(items)
+                    new_item = update(dict(item))
+                    if new_item is None:
+                        del items[position]
+                    else:
+                        items[position] = new_item
+                    self._write_segment(part, index, items)
+                    return new_item if new_item is not None else item
+        return None
+
+def _collection_lock(collection):
+    """Collection lock recording waits, holds and call sites (see locks.py)"""
+    return InstrumentedLock(collection, waits=_op_seconds.labels(collection, 'lock_wait'),
+                            holds=_op_seconds.labels(collection, 'lock_hold'))
+
 class JSONStorage:
-    """Thread-safe JSON storage system"""
+    """Thread-safe JSON storage system
+    
+    In resident mode every collection is parsed once and kept in memory.
+    Reads are served from memory, writes go to memory and disk together,
+    and a file changed by someone else (detected by mtime/size) is reloaded
+    on the next access.
     
-    def __init__(self, storage_dir='instance'):
+    In journal mode a write appends one JSON line per changed item to
+    `<collection>.log` instead of rewriting `<collection>.json`. A background
+    compactor periodically folds the journal into the snapshot; loading a
+    collection reads the snapshot and replays whatever journal is left.
+    
+    Partitioned collections (messages) are kept in per-channel segment
+    files instead, see _SegmentedCollection.
+    
+    Snapshots and segments are rewritten through a temp file and rename.
+    With fsync enabled a write returns only once it is on disk; appends of
+    concurrent writers are flushed together (see _GroupCommit), after the
+    collection lock is released.
+    """
+    
+    def __init__(self, storage_dir='instance', resident=True, journal=True,
+                 compact_every=1000, compact_interval=5.0, indexes=None,
+                 partitions=None, segment_size=1000, id_block=100, codec='json',
+                 fsync=True, commit_window=0.002, green=False):
         self.storage_dir = storage_dir
+        if codec == 'msgpack' and msgpack is None:
+            log.warning('msgpack is not installed, using json codec')
+            codec = 'json'
+        self.codec = CODECS[codec]
+        self.indexes = DEFAULT_INDEXES if indexes is None else indexes
+        self.resident = resident
+        self.journal = journal
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self._cache = {}
+        self.id_block = id_block
+        self._sequences = {}
+        self.fsync = fsync
+        self._commits = _GroupCommit(commit_window, fsync, green)
         if not os.path.exists(storage_dir):
             os.makedirs(storage_dir, exist_ok=True)
         
         self.locks = {
-            'users': Lock(),
-            'user_settings': Lock(),
-            'servers': Lock(),
-            'server_members': Lock(),
-            'channels': Lock(),
-            'messages': Lock(),
-            'friend_requests': Lock(),
-            'friendships': Lock(),
-            'dm_channels': Lock()
+            'users': _collection_lock('users'),
+            'user_settings': _collection_lock('user_settings'),
+            'servers': _collection_lock('servers'),
+            'server_members': _collection_lock('server_members'),
+            'channels': _collection_lock('channels'),
+            'messages': _collection_lock('messages'),
+            'friend_requests': _collection_lock('friend_requests'),
+            'friendships': _collection_lock('friendships'),
+            'dm_channels': _collection_lock('dm_channels'),
+            'changes': _collection_lock('changes'),
+            'presence': _collection_lock('presence')
+        }
+        
+        self.segmented = {
+            collection: _SegmentedCollection(os.path.join(storage_dir, collection), keys, segment_size, resident, self._commits)
+            for collection, keys in (DEFAULT_PARTITIONS if partitions is None else partitions).items()
         }
         
         self._init_storage()
+        
+        if self.journal:
+            threading.Thread(target=self._compact_loop, name='storage-compactor', daemon=True).start()
+    
+    def _get_file_path(self, collection, codec=None):
+        return os.path.join(self.storage_dir, collection + (codec or self.codec).extension)
+    
+    def _get_journal_path(self, collection):
+        return os.path.join(self.storage_dir, f'{collection}.log')
     
-    def _get_file_path(self, collection):
-        return os.path.join(self.storage_dir, f'{collection}.json')
+    def _get_compacting_path(self, collection):
+        return self._get_journal_path(collection) + '.compacting'
+    
+    def _get_sequence_path(self, collection):
+        return os.path.join(self.storage_dir, f'{collection}.seq')
+    
+    def _sequence(self, collection):
+        """ID sequence of a collection. Must be called with the collection lock held."""
+        sequence = self._sequences.get(collection)
+        if sequence is None:
+            # Seed from existing data once, for stores created before sequences
+            if collection in self.segmented:
+                floor = self.segmented[collection].last_id
+            else:
+                floor = max((i.get('id', 0) for i in self._load(collection).items), default=0)
+            sequence = _IdSequence(self._get_sequence_path(collection), floor, self.id_block, self.fsync, self._commits)
+            self._sequences[collection] = sequence
+        return sequence
     
     def _init_storage(self):
         """Initialize empty storage files if they don't exist"""
         for collection in self.locks.keys():
+            self._migrate_codec(collection)
+            if collection in self.segmented:
+                self._migrate_to_segments(collection)
+                continue
             file_path = self._get_file_path(collection)
             if not os.path.exists(file_path):
                 self._write_file(collection, [])
     
+    def _migrate_codec(self, collection):
+        """Rewrite a snapshot left in another format (indented JSON, other codec)"""
+        file_path = self._get_file_path(collection)
+        for codec in CODECS.values():
+            path = self._get_file_path(collection, codec)
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                raw = f.read()
+            detected = _detect_codec(raw)
+            legacy = detected is CODECS['json'] and raw.startswith(b'[\n')
+            if path == file_path and detected is self.codec and not legacy:
+                continue
+            if detected is CODECS['msgpack'] and msgpack is None:
+                raise RuntimeError(f'{path} is msgpack-encoded but msgpack is not installed')
+            items = self._decode(path, raw)
+            self._write_file(collection, items)
+            if path != file_path:
+                os.remove(path)
+            log.info('Converted %s to %s (%d -> %d bytes)', os.path.basename(path), self.codec.name, len(raw), os.path.getsize(file_path))
+    
+    def _migrate_to_segments(self, collection):
+        """Move a collection kept in a single file into partition segments"""
+        file_path = self._get_file_path(collection)
+        if not os.path.exists(file_path):
+            return
+        log.info('Splitting %s into partitions...', collection)
+        items = sorted(self._load(collection).items, key=lambda i: i.get('id', 0))
+        self._cache.pop(collection, None)
+        ticket = 0
+        for start in range(0, len(items), MIGRATION_CHUNK):
+            ticket = self.segmented[collection].append_many(items[start:start + MIGRATION_CHUNK])
+        # Segments must be on disk before the source file goes away
+        self._commits.wait(ticket)
+        os.replace(file_path, file_path + '.migrated')
+        for path in (self._get_compacting_path(collection), self._get_journal_path(collection)):
+            if os.path.exists(path):
+                os.remove(path)
+        log.info('Moved %d %s into partitions', len(items), collection)
+    
+    def _decode(self, path, raw):
+        """Decode a snapshot, raising CorruptedFileError if it is damaged.
+        
+        The file is left untouched: reading it as an empty collection would
+        wipe it on the next write.
+        """
+        try:
+            data = _detect_codec(raw).loads(raw)
+        except Exception as e:
+            raise CorruptedFileError(f'{path} is damaged ({e}); restore it or move it away to start empty') from e
+        if not isinstance(data, list):
+            raise CorruptedFileError(f'{path} does not contain a list of items')
+        return data
+    
     def _read_file(self, collection):
-        """Read JSON file for a collection"""
+        """Read snapshot file for a collection"""
         file_path = self._get_file_path(collection)
+        started = time.perf_counter()
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
+            with open(file_path, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
             return []
+        _timed(collection, 'read', started, len(raw))
+        started = time.perf_counter()
+        data = self._decode(file_path, raw)
+        _timed(collection, 'parse', started)
+        return data
     
     def _write_file(self, collection, data):
-        """Write JSON file for a collection"""
-        file_path = self._get_file_path(collection)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False, default=str)
+        """Atomically replace the snapshot file of a collection"""
+        started = time.perf_counter()
+        raw = self.codec.dumps(list(data))
+        self._commits.run(_atomic_write, self._get_file_path(collection), raw, self.fsync)
+        _timed(collection, 'write', started, len(raw))
+    
+    def _append_journal(self, collection, records):
+        """Append records to the collection journal as JSON lines; returns a commit ticket"""
+        path = self._get_journal_path(collection)
+        created = _append_jsonl(path, records, collection)
+        return self._commits.written(path, [self.storage_dir] if created else [])
+    
+    def _file_signature(self, collection):
+        """Cheap change marker for a collection's files (mtime and size)"""
+        return (_path_signature(self._get_file_path(collection)),
+                _path_signature(self._get_compacting_path(collection)),
+                _path_signature(self._get_journal_path(collection)))
+    
+    def _load(self, collection):
+        """Return the in-memory collection, (re)reading the files only when they changed.
+        
+        Must be called with the collection lock held.
+        """
+        signature = self._file_signature(collection)
+        state = self._cache.get(collection)
+        if state is None or state.signature != signature:
+            state = _Collection(self._read_file(collection), signature, self.indexes.get(collection, ()))
+            for path in (self._get_compacting_path(collection), self._get_journal_path(collection)):
+                for record in _read_jsonl(path, collection):
+                    state.apply(record)
+                    state.journal_records += 1
+            if self.resident:
+                self._cache[collection] = state
+        return state
+    
+    def _persist(self, collection, state, records):
+        """Write changes to disk after they were applied to the in-memory collection.
+        
+        Must be called with the collection lock held. In journal mode only
+        `records` are appended, otherwise the whole collection is rewritten.
+        If the write fails the resident copy is dropped so the next access
+        re-reads the files. Returns a ticket to pass to _commits.wait()
+        once the lock is released.
+        """
+        if not records:
+            return 0
+        ticket = 0
+        try:
+            if self.journal:
+                ticket = self._append_journal(collection, records)
+                state.journal_records += len(records)
+            else:
+                self._write_file(collection, state.items)
+                # The snapshot now covers anything left from journal mode
+                for path in (self._get_compacting_path(collection), self._get_journal_path(collection)):
+                    if os.path.exists(path):
+                        os.remove(path)
+        except Exception:
+            self._cache.pop(collection, None)
+            raise
+        state.signature = self._file_signature(collection)
+        return ticket
+    
+    def compact(self, collection):
+        """Fold the collection journal into its snapshot file"""
+        journal_path = self._get_journal_path(collection)
+        compacting_path = self._get_compacting_path(collection)
+        with self.locks[collection]:
+            state = self._load(collection)
+            if not os.path.exists(journal_path):
+                return
+            if self.fsync:
+                # Writers still waiting on the group commit are covered by this
+                _fsync_file(journal_path)
+            if os.path.exists(compacting_path):
+                # Left over from an interrupted compaction: keep both parts
+                with open(journal_path, 'r', encoding='utf-8') as src, \
+                     open(compacting_path, 'a', encoding='utf-8') as dst:
+                    dst.write(src.read())
+                os.remove(journal_path)
+            else:
+                os.replace(journal_path, compacting_path)
+            items = [dict(item) for item in state.items]
+            state.journal_records = 0
+            state.signature = self._file_signature(collection)
+        
+        # Writes keep appending to a fresh journal while the snapshot is dumped
+        tmp_path = self._get_file_path(collection) + '.tmp'
+        started = time.perf_counter()
+        raw = self.codec.dumps(items)
+        self._commits.run(_write_durable, tmp_path, raw, self.fsync)
+        _timed(collection, 'write', started, len(raw))
+        
+        with self.locks[collection]:
+            os.replace(tmp_path, self._get_file_path(collection))
+            if self.fsync:
+                # The new snapshot must be on disk before the journal it replaces goes
+                _fsync_dir(self.storage_dir)
+            os.remove(compacting_path)
+            if collection in self._cache:
+                self._cache[collection].signature = self._file_signature(collection)
+    
+    def _compact_loop(self):
+        """Compact every journal that grew past compact_every records"""
+        while True:
+            time.sleep(self.compact_interval)
+            for collection in self.locks.keys():
+                if collection in self.segmented:
+                    continue
+                with self.locks[collection]:
+                    pending = self._load(collection).journal_records
+                if pending < self.compact_every:
+                    continue
+                try:
+                    self.compact(collection)
+                except Exception as e:
+                    log.error('Compaction of %s failed: %s', collection, e)
     
     def get_all(self, collection):
         """Get all items from a collection"""
         with self.locks[collection]:
-            return self._read_file(collection)
+            if collection in self.segmented:
+                return [dict(item) for item in self.segmented[collection].all()]
+            return [dict(item) for item in self._load(collection).items]
     
     def get_by_id(self, collection, item_id):
         """Get item by ID"""
-        items = self.get_all(collection)
-        for item in items:
-            if item.get('id') == item_id:
-                return item
-        return None
+        if collection in self.segmented:
+            return self.get_one_by_fields(collection, {'id': item_id})
+        if not _hashable(item_id):
+            return None
+        with self.locks[collection]:
+            item = self._load(collection).by_id.get(item_id)
+            return dict(item) if item is not None else None
+    
+    def get_many(self, collection, item_ids):
+        """Get several items by ID in one pass, as {id: item} (missing IDs are left out)"""
+        item_ids = {item_id for item_id in item_ids if _hashable(item_id)}
+        if collection in self.segmented:
+            return {item['id']: item for item in self.get_all(collection) if item.get('id') in item_ids}
+        with self.locks[collection]:
+            by_id = self._load(collection).by_id
+            return {item_id: dict(by_id[item_id]) for item_id in item_ids if item_id in by_id}
     
     def get_by_field(self, collection, field, value):
         """Get items by field value"""
-        items = self.get_all(collection)
-        return [item for item in items if item.get(field) == value]
+        return self.get_by_fields(collection, {field: value})
     
     def get_one_by_field(self, collection, field, value):
         """Get one item by field value"""
-        items = self.get_all(collection)
-        for item in items:
-            if item.get(field) == value:
-                return item
-        return None
+        return self.get_one_by_fields(collection, {field: value})
+    
+    def get_by_fields(self, collection, fields):
+        """Get items matching all of the given field values"""
+        with self.locks[collection]:
+            return [dict(item) for item in self._find(collection, fields)]
+    
+    def get_one_by_fields(self, collection, fields):
+        """Get one item matching all of the given field values"""
+        with self.locks[collection]:
+            for item in self._find(collection, fields):
+                return dict(item)
+            return None
+    
+    def _find(self, collection, fields):
+        if not all(_hashable(value) for value in fields.values()):
+            return []
+        if collection in self.segmented:
+            return self.segmented[collection].find(fields)
+        return self._load(collection).find(fields)
+    
+    def get_page(self, collection, field, value, limit, before=None, after=None, around=None):
+        """Get up to `limit` items with field == value next to an id cursor.
+        
+        Items come oldest first. With no cursor these are the newest items,
+        `before`/`after` page backwards/forwards from an id, and `around`
+        centers the page on an id (inclusive). Returns (items, has_more),
+        has_more telling whether items exist past the page.
+        
+        For a partitioned collection keyed by `field` this reads only the
+        segments of one partition around the cursor.
+        """
+        if around is not None:
+            older, more_older = self.get_page(collection, field, value, limit - limit // 2, before=around + 1)
+            newer, more_newer = self.get_page(collection, field, value, limit // 2, after=around)
+            return older + newer, more_older or more_newer
+        
+        with self.locks[collection]:
+            segmented = self.segmented.get(collection)
+            if segmented is not None and field in segmented.keys:
+                items, has_more = segmented.page(segmented.partition_name({field: value}), limit, before, after)
+            else:
+                items = sorted(self._find(collection, {field: value}), key=_item_id)
+                if after is not None:
+                    items = items[bisect_right(items, after, key=_item_id):]
+                    items, has_more = items[:limit], len(items) > limit
+                else:
+                    if before is not None:
+                        items = items[:bisect_left(items, before, key=_item_id)]
+                    items, has_more = items[max(len(items) - limit, 0):], len(items) > limit
+            return [dict(item) for item in items], has_more
+    
+    def get_latest(self, collection, field, value, limit):
+        """Get the newest `limit` items with field == value, oldest first"""
+        return self.get_page(collection, field, value, limit)[0]
+    
+    def get_after(self, collection, after_id):
+        """All items with id > after_id, oldest first"""
+        with self.locks[collection]:
+            segmented = self.segmented.get(collection)
+            if segmented is not None:
+                items = segmented.after(after_id)
+            else:
+                items = [item for item in self._load(collection).items if _item_id(item) > after_id]
+            return [dict(item) for item in sorted(items, key=_item_id)]
+    
+    def get_last_id(self, collection):
+        """Highest id stored in a collection (0 if it is empty)"""
+        with self.locks[collection]:
+            segmented = self.segmented.get(collection)
+            if segmented is not None:
+                return segmented.last_id
+            return max((_item_id(item) for item in self._load(collection).items), default=0)
     
     def add(self, collection, item):
         """Add new item to collection"""
+        return self.add_many(collection, [item])[0]
+    
+    def add_many(self, collection, items):
+        """Add several items under one lock, with one disk write and one commit"""
         with self.locks[collection]:
-            items = self._read_file(collection)
-            # Generate ID if not present
-            if 'id' not in item:
-                max_id = max([i.get('id', 0) for i in items] + [0])
-                item['id'] = max_id + 1
+            sequence = self._sequence(collection)
+            for item in items:
+                # Generate ID if not present
+                if 'id' not in item:
+                    item['id'] = sequence.next()
+                else:
+                    sequence.observe(item['id'])
+                
+                # Add timestamps if not present
+                if 'created_at' not in item:
+                    item['created_at'] = datetime.utcnow().isoformat()
             
-            # Add timestamps if not present
-            if 'created_at' not in item:
-                item['created_at'] = datetime.utcnow().isoformat()
-            
-            items.append(item)
-            self._write_file(collection, items)
-            return item
+            stored = [dict(item) for item in items]
+            if collection in self.segmented:
+                ticket = self.segmented[collection].append_many(stored)
+            else:
+                state = self._load(collection)
+                for item in stored:
+                    state.put(item)
+                ticket = self._persist(collection, state, [{'op': 'put', 'item': item} for item in stored])
+        
+        self._commits.wait(ticket)
+        return items
     
     def update(self, collection, item_id, updates):
-        """Update item in collection"""
+        """Update item in collection.
+        
+        `updates` is a dict or a function of the current item returning
+        one; a function runs under the collection lock, so read-modify-write
+        updates (counters) are not lost. It must not call storage itself:
+        read whatever else it needs before calling update.
+        """
+        def apply_updates(item):
+            item.update(updates(dict(item)) if callable(updates) else updates)
+            if 'updated_at' not in item:
+                item['updated_at'] = datetime.utcnow().isoformat()
+            return item
+        
         with self.locks[collection]:
-            items = self._read_file(collection)
-            for i, item in enumerate(items):
-                if item.get('id') == item_id:
-                    items[i].update(updates)
-                    if 'updated_at' not in items[i]:
-                        items[i]['updated_at'] = datetime.utcnow().isoformat()
-                    self._write_file(collection, items)
-                    return items[i]
-            return None
+            if collection in self.segmented:
+                item = self.segmented[collection].replace(item_id, apply_updates)
+                return dict(item) if item is not None else None
+            state = self._load(collection)
+            item = state.by_id.get(item_id)
+            if item is None:
+                return None
+            item = apply_updates(dict(item))
+            state.put(item)
+            ticket = self._persist(collection, state, [{'op': 'put', 'item': item}])
+            item = dict(item)
+        
+        self._commits.wait(ticket)
+        return item
     
     def delete(self, collection, item_id):
         """Delete item from collection"""
         with self.locks[collection]:
-            items = self._read_file(collection)
-            items = [item for item in items if item.get('id') != item_id]
-            self._write_file(collection, items)
-            return True
+            if collection in self.segmented:
+                self.segmented[collection].replace(item_id, lambda item: None)
+                return True
+            state = self._load(collection)
+            ticket = 0
+            if state.remove(item_id) is not None:
+                ticket = self._persist(collection, state, [{'op': 'del', 'id': item_id}])
+        
+        self._commits.wait(ticket)
+        return True
     
     def delete_by_field(self, collection, field, value):
         """Delete items by field value"""
         with self.locks[collection]:
-            items = self._read_file(collection)
-            items = [item for item in items if item.get(field) != value]
-            self._write_file(collection, items)
-            return True
+            if collection in self.segmented:
+                for item in self.segmented[collection].find({field: value}):
+                    self.segmented[collection].replace(item.get('id'), lambda item: None)
+                return True
+            state = self._load(collection)
+            removed = [item.get('id') for item in state.find({field: value})]
+            for item_id in removed:
+                state.remove(item_id)
+            ticket = self._persist(collection, state, [{'op': 'del', 'id': item_id} for item_id in removed])
+        
+        self._commits.wait(ticket)
+        return True
+    
+    def delete_before(self, collection, before_id):
+        """Delete items with id < before_id, for retention.
+        
+        A partitioned collection only drops whole segments, so it may keep
+        some of those items.
+        """
+        with self.locks[collection]:
+            if collection in self.segmented:
+                self.segmented[collection].drop_before(before_id)
+                return True
+            state = self._load(collection)
+            removed = [_item_id(item) for item in state.items if _item_id(item) < before_id]
+            for item_id in removed:
+                state.remove(item_id)
+            ticket = self._persist(collection, state, [{'op': 'del', 'id': item_id} for item_id in removed]) if removed else 0
+        
+        self._commits.wait(ticket)
+        return True
 
 # Global storage instance
-storage = JSONStorage()
+def create_storage():
+    """Storage backend selected by RUCORD_STORAGE_BACKEND (json or sqlite)"""
+    backend = os.environ.get('RUCORD_STORAGE_BACKEND', 'json')
+    if backend == 'sqlite':
+        from sqlite_storage import SQLiteStorage
+        return SQLiteStorage(os.environ.get('RUCORD_SQLITE_PATH', os.path.join('instance', 'rucord.db')), DEFAULT_INDEXES)
+    if backend != 'json':
+        raise ValueError(f'Unknown storage backend: {backend}')
+    if os.environ.get('SOCKETIO_MESSAGE_QUEUE'):
+        # A message queue means several instances; their caches and reserved ID blocks would diverge
+        raise RuntimeError('The json storage backend supports a single instance; '
+                           'set RUCORD_STORAGE_BACKEND=sqlite to run several instances with SOCKETIO_MESSAGE_QUEUE')
+    return JSONStorage(
+        resident=os.environ.get('RUCORD_STORAGE_RESIDENT', '1') != '0',
+        journal=os.environ.get('RUCORD_STORAGE_JOURNAL', '1') != '0',
+        compact_every=int(os.environ.get('RUCORD_STORAGE_COMPACT_EVERY', 1000)),
+        segment_size=int(os.environ.get('RUCORD_STORAGE_SEGMENT_SIZE', 1000)),
+        id_block=int(os.environ.get('RUCORD_STORAGE_ID_BLOCK', 100)),
+        codec=os.environ.get('RUCORD_STORAGE_CODEC', 'json'),
+        fsync=os.environ.get('RUCORD_STORAGE_FSYNC', '1') != '0',
+        commit_window=float(os.environ.get('RUCORD_STORAGE_COMMIT_WINDOW_MS', 2)) / 1000,
+        green=_eventlet_patched()
+    )
+
+storage = create_storage()
+
+# Helper functions for password hashing (blocking; servers use passwords.PasswordPool)
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
 
-# Helper functions for password hashing
 def hash_password(password):
     """Hash a password"""
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
 
 def check_password(password, password_hash):
     """Check if password matches hash"""
     return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
-
@@ -0,0 +1,95 @@
+"""
+Verified access token cache for RUCord
+
+Decoding a JWT means parsing it and checking its HMAC signature, and
+every REST request and socket connection did that again for the same few
+tokens. TokenCache keeps the result of a successful check: token ->
+user id and expiry, plus a projection of the user row loaded on first
+use. Authorizing a request with a known token is a dictionary lookup.
+
+Entries live for `ttl` seconds and never past the token's own expiry.
+The cache holds at most `max_size` tokens and drops the least recently
+used one first. forget_user() drops the cached projection of a user
+after their row changes. Other processes do not see that call, so their
+projection can be up to `ttl` seconds old. Tokens that fail the check
+are never cached.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# User fields kept with a token; never the password hash
+USER_FIELDS = ('id', 'username', 'avatar', 'status', 'status_message', 'created_at')
+
+class _Entry:
+    def __init__(self, user_id, valid_until):
+        self.user_id = user_id
+        self.valid_until = valid_until
+        self.user = None
+
+class TokenCache:
+    """Bounded LRU of verified tokens with TTL eviction"""
+    
+    def __init__(self, decode, load_user, max_size=10000, ttl=60.0):
+        # decode(token) -> claims, raising on an invalid or expired token
+        self.decode = decode
+        # load_user(user_id) -> user row or None
+        self.load_user = load_user
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+        # token -> _Entry, least recently used first
+        self.entries = OrderedDict()
+        # user id -> tokens of the user in entries
+        self.tokens = {}
+    
+    def _drop(self, token):
+        entry = self.entries.pop(token)
+        tokens = self.tokens.get(entry.user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens[entry.user_id]
+    
+    def verify(self, token):
+        """Cache entry of a valid token; decode errors propagate"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is not None:
+                if entry.valid_until > now:
+                    self.entries.move_to_end(token)
+                    return entry
+                self._drop(token)
+        
+        claims = self.decode(token)
+        valid_until = now + self.ttl
+        if claims.get('exp'):
+            valid_until = min(valid_until, claims['exp'])
+        entry = _Entry(claims['sub'], valid_until)
+        with self.lock:
+            if token in self.entries:
+                self._drop(token)
+            self.entries[token] = entry
+            self.tokens.setdefault(entry.user_id, set()).add(token)
+            while len(self.entries) > self.max_size:
+                self._drop(next(iter(self.entries)))
+        return entry
+    
+    def user(self, entry):
+        """Projection of the entry's user row (USER_FIELDS), or None if the user is gone"""
+        user = entry.user
+        if user is None:
+            row = self.load_user(entry.user_id)
+            if row is None:
+                return None
+            user = {field: row.get(field) for field in USER_FIELDS}
+            with self.lock:
+                entry.user = user
+        return user
+    
+    def forget_user(self, user_id):
+        """Drop the cached projection of a user after their row changed"""
+        with self.lock:
+            for token in self.tokens.get(user_id, ()):
+                self.entries[token].user = None